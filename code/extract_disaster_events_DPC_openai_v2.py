@@ -13,6 +13,11 @@ import base64
 import json
 import psycopg2 # (Optional)
 import pandas as pd
+import sys
+
+# Shared on-disk cache of OpenAI responses, imported from the same folder (whatever the working directory)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from surveylm_openai_cache_v1 import cached_completion_content
 
 ### --- Planned Updates, Wish List, Random Thoughts/Ideas Log: --- ###
 
@@ -203,7 +208,7 @@ def extract_disaster_events_from_text(text_input, temperature_setting=0.7, max_t
     # The final user message prompt
     user_message = f"{user_content} {end_content}"
     # Call to the language model for processing
-    response = client.beta.chat.completions.parse(
+    response_content = cached_completion_content(client.beta.chat.completions.parse,
         model=model_setting,
         messages=[
             {
@@ -224,7 +229,7 @@ def extract_disaster_events_from_text(text_input, temperature_setting=0.7, max_t
         frequency_penalty=frequency_penalty_setting,
         logprobs=logprobs_setting,
     )
-    return response.choices[0].message.content
+    return response_content
 
 
 # Example usage
@@ -328,7 +333,7 @@ def extract_disaster_events_from_text(text_input, temperature_setting=0.7, max_t
     # The final user message prompt
     user_message = f"{user_content} {end_content}"
     # Call to the language model for processing
-    response = client.beta.chat.completions.parse(
+    response_content = cached_completion_content(client.beta.chat.completions.parse,
         model=model_setting,
         messages=[
             {
@@ -349,7 +354,7 @@ def extract_disaster_events_from_text(text_input, temperature_setting=0.7, max_t
         frequency_penalty=frequency_penalty_setting,
         logprobs=logprobs_setting,
     )
-    return response.choices[0].message.content
+    return response_content
 
 # Now run on the first few pages (in chunks?)
 pages=extract_text_from_pdf("queensland-disaster-management-committee-annual-report-2023-2024.pdf", start_page=2, end_page=7) # It starts to break down (i.e. miss events) a bit when we go beyond 10 pages
@@ -447,7 +452,7 @@ def extract_disaster_event_details_from_text(text_input, events_catalog, tempera
     # The final user message prompt
     user_message = f"{user_content} {end_content}"
     # Call to the language model for processing
-    response = client.beta.chat.completions.parse(
+    response_content = cached_completion_content(client.beta.chat.completions.parse,
         model=model_setting,
         messages=[
             {
@@ -468,7 +473,7 @@ def extract_disaster_event_details_from_text(text_input, events_catalog, tempera
         frequency_penalty=frequency_penalty_setting,
         logprobs=logprobs_setting,
     )
-    return response.choices[0].message.content
+    return response_content
 
 # Now run the LLM API processing pipeline on the chunks (all pages of the supplied pdf)
 def collect_all_event_details(pdf_path, events_catalog, chunk_size=5):
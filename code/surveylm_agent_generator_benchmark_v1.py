@@ -0,0 +1,162 @@
+##### ------ IMPORT FUNCTIONS + SETUP CODE - START ------- ####
+
+import os
+import sys
+import json
+import time
+import tracemalloc
+import platform
+import itertools
+import tempfile
+import datetime
+import numpy as np
+import pandas as pd
+
+# Import the agent generator from the same folder (whatever the working directory)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from surveylm_agent_generator_v11 import (read_input_file, read_profile_spec, generate_agent_profiles_with_dependencies, generate_agent_profiles_batch,
+                                          create_joint_probability_matrix, create_sparse_joint_distribution, generate_sample_population,
+                                          generate_country_sample_populations)
+
+##### ------ DEFINE FUNCTIONS - START ------- ####
+
+# Function to generate a synthetic agent inputs (spec) sheet, in the layout of 'sample_profile_generation_input_v5.xlsx'
+def generate_synthetic_spec(num_items, num_options, dependency_fraction=0.5, max_parents=1, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(num_items):
+        options = [f"Item {i} option {j}" for j in range(num_options)]
+        row = {'item_name': f"Item {i}", 'option_set': ';'.join(options), 'item_probability_distribution': ';'.join(map(str, rng.dirichlet(np.ones(num_options)).tolist())),
+               'item_cross_probability_with_item_names': np.nan, 'item_cross_probability_with_item_probabilities': np.nan, 'item_probability_set': np.nan,
+               'item_probability_set_type': np.nan, 'item_probability_set_n_options': np.nan, 'item_probability_set_jumps': np.nan}
+        if i > 0 and rng.random() < dependency_fraction:
+            parents = sorted(rng.choice(i, size=min(int(rng.integers(1, max_parents + 1)), i), replace=False).tolist())
+            row['item_cross_probability_with_item_names'] = ';'.join(f"Item {parent}" for parent in parents)
+            row['item_cross_probability_with_item_probabilities'] = ';'.join(map(str, rng.dirichlet(np.ones(num_options), size=num_options ** len(parents)).ravel().tolist()))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+# Function to generate a synthetic panel dataset, in the layout of the synthetic WVS csv (one country column plus categorical columns)
+def generate_synthetic_panel(num_rows, num_columns, num_options, num_countries, country_col='Country_Code', seed=0):
+    rng = np.random.default_rng(seed)
+    panel = {country_col: np.array([f"Country {c}" for c in range(num_countries)], dtype=object)[rng.integers(0, num_countries, num_rows)]}
+    for c in range(num_columns):
+        # Skewed (Dirichlet) option frequencies, so that the joint distribution is not uniform
+        panel[f"Column {c}"] = np.array([f"Option {j}" for j in range(num_options)], dtype=object)[rng.choice(num_options, size=num_rows, p=rng.dirichlet(np.ones(num_options)))]
+    return pd.DataFrame(panel)
+
+# Function to time a stage (best and median of several repeats), then measure its peak traced memory in one extra (traced) run
+def measure_stage(stage_function, repeats=3):
+    seconds = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        stage_function()
+        seconds.append(time.perf_counter() - start_time)
+    tracemalloc.start()
+    try:
+        stage_function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(seconds), 'seconds_median': float(np.median(seconds)), 'peak_memory_mb': peak_memory / 2 ** 20}
+
+# Function to benchmark one stage for one set of parameters, i.e. one record of the JSON report
+def benchmark_record(stage, params, stage_function, units, unit='agents', repeats=3):
+    record = {'stage': stage, 'params': params, 'unit': unit, 'units': units}
+    try:
+        record.update(measure_stage(stage_function, repeats=repeats))
+        record['units_per_second'] = units / record['seconds'] if record['seconds'] > 0 else None
+    except Exception as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+    print(f"{stage} {params}: " + (f"{record['seconds']:.4f}s, {record['peak_memory_mb']:.1f}MB" if 'error' not in record else record['error']))
+    return record
+
+# Function to benchmark the spec-based stages (reading the spec, then generating agents) across a parameter grid
+def run_spec_benchmarks(spec_grid, num_agents_list, repeats=3, legacy_max_agents=1000, tmp_dir=None):
+    records = []
+    tmp_dir = tmp_dir if tmp_dir is not None else tempfile.mkdtemp(prefix='agent_generator_benchmark_')
+    for num_items, num_options, dependency_fraction, max_parents in itertools.product(spec_grid['num_items'], spec_grid['num_options'], spec_grid['dependency_fraction'], spec_grid['max_parents']):
+        spec_params = {'num_items': num_items, 'num_options': num_options, 'dependency_fraction': dependency_fraction, 'max_parents': max_parents}
+        spec_path = os.path.join(tmp_dir, f"spec_{num_items}_{num_options}_{dependency_fraction}_{max_parents}.xlsx")
+        generate_synthetic_spec(num_items, num_options, dependency_fraction, max_parents).to_excel(spec_path, index=False)
+        records += benchmark_records_for_spec(spec_path, spec_params, num_agents_list, repeats=repeats, legacy_max_agents=legacy_max_agents)
+    return records
+
+# Function to benchmark reading one spec file and generating agents from it
+def benchmark_records_for_spec(spec_path, spec_params, num_agents_list, repeats=3, legacy_max_agents=1000):
+    records = []
+    num_items = len(pd.read_excel(spec_path))
+    records.append(benchmark_record('read_input_file', spec_params, lambda: read_input_file(spec_path, "from_all_equally"), num_items, unit='items', repeats=repeats))
+    spec = read_profile_spec(spec_path)
+    spec_df = spec.to_dataframe()
+    for num_agents in num_agents_list:
+        params = {**spec_params, 'num_agents': num_agents}
+        records.append(benchmark_record('generate_agent_profiles_batch', params, lambda: generate_agent_profiles_batch(spec, num_agents, seed=0), num_agents, repeats=repeats))
+        # The legacy generator is one agent and one item at a time (so only timed on small populations)
+        if num_agents <= legacy_max_agents:
+            records.append(benchmark_record('generate_agent_profiles_with_dependencies', params, lambda: generate_agent_profiles_with_dependencies(spec_df, num_agents, seed=0), num_agents, repeats=1))
+    return records
+
+# Function to benchmark the panel-based stages (joint distributions, then sample populations) across a parameter grid
+def run_panel_benchmarks(panel_grid, num_agents_list, repeats=3):
+    records = []
+    for num_rows, num_columns, num_options, num_countries in itertools.product(panel_grid['num_rows'], panel_grid['num_columns'], panel_grid['num_options'], panel_grid['num_countries']):
+        panel_params = {'num_rows': num_rows, 'num_columns': num_columns, 'num_options': num_options, 'num_countries': num_countries}
+        panel_df = generate_synthetic_panel(num_rows, num_columns, num_options, num_countries)
+        records += benchmark_records_for_panel(panel_df, 'Country_Code', [col for col in panel_df.columns if col != 'Country_Code'], panel_params, num_agents_list, repeats=repeats)
+    return records
+
+# Function to benchmark the sample population stages on one panel dataset
+def benchmark_records_for_panel(panel_df, country_col, columns_of_interest, panel_params, num_agents_list, repeats=3):
+    records = []
+    records.append(benchmark_record('create_joint_probability_matrix', panel_params, lambda: create_joint_probability_matrix(panel_df, columns_of_interest), len(panel_df), unit='rows', repeats=repeats))
+    records.append(benchmark_record('create_sparse_joint_distribution', panel_params, lambda: create_sparse_joint_distribution(panel_df, columns_of_interest), len(panel_df), unit='rows', repeats=repeats))
+    joint_prob_matrix = create_joint_probability_matrix(panel_df, columns_of_interest)
+    sparse_joint = create_sparse_joint_distribution(panel_df, columns_of_interest)
+    num_countries = panel_df[country_col].nunique()
+    for num_agents in num_agents_list:
+        params = {**panel_params, 'num_agents': num_agents}
+        records.append(benchmark_record('generate_sample_population', params, lambda: generate_sample_population(joint_prob_matrix, num_agents, seed=0), num_agents, repeats=repeats))
+        records.append(benchmark_record('generate_sample_population (sparse)', params, lambda: generate_sample_population(sparse_joint, num_agents, seed=0), num_agents, repeats=repeats))
+        # num_agents is the total over all countries here
+        records.append(benchmark_record('generate_country_sample_populations', params, lambda: generate_country_sample_populations(panel_df, country_col, columns_of_interest, max(num_agents // num_countries, 1), seed=0),
+                                        max(num_agents // num_countries, 1) * num_countries, repeats=repeats))
+    return records
+
+# Function to run the whole benchmark suite (fixed fixtures plus the synthetic parameter grids) and save the report as JSON
+def run_benchmark_suite(spec_grid, panel_grid, num_agents_list, fixture_spec_path, fixture_panel_path, output_path, repeats=3, legacy_max_agents=1000):
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'numpy': np.__version__, 'pandas': pd.__version__, 'cpu_count': os.cpu_count()},
+        'config': {'spec_grid': spec_grid, 'panel_grid': panel_grid, 'num_agents_list': num_agents_list, 'repeats': repeats, 'legacy_max_agents': legacy_max_agents},
+        'records': [],
+    }
+    # Fixed fixtures first, so that runs with different grids can still be compared
+    report['records'] += benchmark_records_for_spec(fixture_spec_path, {'fixture': os.path.basename(fixture_spec_path)}, num_agents_list, repeats=repeats, legacy_max_agents=legacy_max_agents)
+    fixture_panel = pd.read_csv(fixture_panel_path)
+    fixture_columns = ['Sex', 'Age', 'Education level (recoded)', 'Scale of incomes', 'Social class (subjective)']
+    report['records'] += benchmark_records_for_panel(fixture_panel, 'Country_Code', fixture_columns, {'fixture': os.path.basename(fixture_panel_path)}, num_agents_list, repeats=repeats)
+    report['records'] += run_spec_benchmarks(spec_grid, num_agents_list, repeats=repeats, legacy_max_agents=legacy_max_agents)
+    report['records'] += run_panel_benchmarks(panel_grid, num_agents_list, repeats=repeats)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Saved {len(report['records'])} benchmark records to {output_path}")
+    return report
+
+##### ------ MAIN CODE - START ------- ####
+
+if __name__ == "__main__":
+    repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    fixture_spec_path = os.path.join(repo_dir, 'data', 'inputs', 'agent_profile_specifications', 'sample_profile_generation_input_v5.xlsx')
+    fixture_panel_path = os.path.join(repo_dir, 'data', 'inputs', 'panel_datasets', 'synthetic_WVS_TimeSeries_1981_2022_Stata_v3_0_combined.csv')
+    output_path = os.path.join(repo_dir, 'data', 'outputs', 'benchmarks', 'agent_generator_benchmark_' + datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+
+    # Parameter grids (every combination is run, so keep these small)
+    spec_grid = {'num_items': [5, 30], 'num_options': [5, 11], 'dependency_fraction': [0.0, 0.5], 'max_parents': [1, 2]}
+    panel_grid = {'num_rows': [10000, 450000], 'num_columns': [5, 15], 'num_options': [6], 'num_countries': [100]}
+    num_agents_list = [1000, 100000]
+
+    benchmark_report = run_benchmark_suite(spec_grid, panel_grid, num_agents_list, fixture_spec_path, fixture_panel_path, output_path, repeats=3, legacy_max_agents=1000)
+
+##### ------ MAIN CODE - END ------- ####
@@ -8,6 +8,16 @@ import os
 import re
 from scipy.stats import norm
 import glob
+import itertools
+import time
+import zlib
+import hashlib
+import json
+import functools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.stats import ks_2samp, chi2_contingency, chi2, kstwo
+from pandas.api.types import union_categoricals
 
 ##### ------ DEFINE FUNCTIONS - START ------- ####
 
@@ -64,125 +74,120 @@ def extract_range(option):
         #print(f"Warning: invalid range format in option: {option}")
     return lower, upper
 
-# (Expensive) Function to
-def update_probability_distribution(df, ind, mean, sd,remove_diff_type="from_all_equally"):
-    for index, row in df.iterrows():
-        if int(index) == int(ind):
-            options = row['option_set'].split(';')
-            if pd.isna(row['item_probability_distribution']):
-                uniform_probability = 1 / len(options)
-                df.at[index, 'item_probability_distribution'] = ';'.join([str(uniform_probability)] * len(options))
-            # Assuming options are given in a way that they can be mapped to ranges
-            all_discrete = True  # To check if all options are discrete
-            probabilities = []
-            for option in options:
-                lower, upper = extract_range(option)
-                if lower != upper:
-                    all_discrete = False
-                # Calculate the cumulative distribution function values
-                lower_cdf = norm.cdf(lower, mean, sd)
-                upper_cdf = norm.cdf(upper + 1, mean, sd)
-                probability = upper_cdf - lower_cdf
-                probabilities.append(probability)
-            if all_discrete:
-                # Handle discrete options
-                probabilities = [norm.pdf(int(option), mean, sd) for option in options]
-            # Normalize the probabilities to sum to 1
-            total_prob = sum(probabilities)
-            normalized_probabilities = [p / total_prob for p in probabilities]
-            # Round the probabilities to the specified number of decimal places
-            rounded_probabilities = [p for p in normalized_probabilities]
-            df.at[index, 'item_probability_distribution'] = ';'.join(map(str, rounded_probabilities))
-            item_probabilities = df.at[index, 'item_probability_distribution'].split(';') if pd.notna(df.at[index, 'item_probability_distribution']) else []
-            probability_values = [float(p) if p else 0.0 for p in item_probabilities]
-            if not np.isclose(sum(probability_values), 1.0):
-                diff_to_fix = sum(probability_values) - 1.0
-                if remove_diff_type == "from_minimum":
-                    min_value = min(probability_values)
-                    probability_values = [float(p - diff_to_fix) if p == min_value else p for p in probability_values]
-                elif remove_diff_type == "from_maximum":
-                    max_value = max(probability_values)
-                    probability_values = [float(p - diff_to_fix) if p == max_value else p for p in probability_values]
-                else: # remove_diff_type == "from_all_equally"
-                    avg_diff_to_fix = diff_to_fix / len(probability_values)
-                    probability_values = [float(p - avg_diff_to_fix) if p else p for p in probability_values]
-                df.at[index, 'item_probability_distribution'] = ';'.join(map(str, probability_values))
-    return df
+# Function to compute the normal distribution probabilities for every item with an "item_probability_set" in one pass, i.e. one
+# (vectorized) norm.cdf call over all options of all items instead of one call per row
+def normalize_probability_sets(option_bounds, mean_sd_pairs, remove_diff_type="from_all_equally"):
+    if not option_bounds:
+        return []
+    lengths = np.array([len(bounds) for bounds in option_bounds])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    bounds = np.array([bound for bounds in option_bounds for bound in bounds], dtype=np.float64).reshape(-1, 2)
+    lower, upper = bounds[:, 0], bounds[:, 1]
+    means = np.repeat(np.array([mean for mean, _ in mean_sd_pairs], dtype=np.float64), lengths)
+    sds = np.repeat(np.array([sd for _, sd in mean_sd_pairs], dtype=np.float64), lengths)
+    # Items where all options are discrete use the density at each option, otherwise the CDF mass of each option's range
+    all_discrete = np.repeat(np.logical_and.reduceat(lower == upper, starts), lengths)
+    probabilities = np.where(all_discrete, norm.pdf(lower, means, sds), norm.cdf(upper + 1, means, sds) - norm.cdf(lower, means, sds))
+    # Normalize the probabilities of each item to sum to 1
+    probabilities = probabilities / np.repeat(np.add.reduceat(probabilities, starts), lengths)
+    # Remove any remaining (floating point) difference from 1, per item
+    totals = np.add.reduceat(probabilities, starts)
+    diff_to_fix = np.repeat(np.where(np.isclose(totals, 1.0), 0.0, totals - 1.0), lengths)
+    if remove_diff_type == "from_minimum":
+        probabilities = np.where(probabilities == np.repeat(np.minimum.reduceat(probabilities, starts), lengths), probabilities - diff_to_fix, probabilities)
+    elif remove_diff_type == "from_maximum":
+        probabilities = np.where(probabilities == np.repeat(np.maximum.reduceat(probabilities, starts), lengths), probabilities - diff_to_fix, probabilities)
+    else: # remove_diff_type == "from_all_equally"
+        probabilities = np.where(probabilities != 0, probabilities - diff_to_fix / np.repeat(lengths, lengths), probabilities)
+    return np.split(probabilities, starts[1:])
+
+# Define a small least-recently-used cache with hit/miss counters (e.g. for the option sets and normal bin probabilities that repeat across spec files)
+class LRUCache:
+    __slots__ = ('maxsize', 'entries', 'hits', 'misses')
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
 
-# Function to
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False) # Evict the least recently used entry
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+
+# Caches shared by every spec file read in this process (see cached_option_set and cached_normalize_probability_sets)
+option_set_cache = LRUCache(maxsize=4096)
+bin_probabilities_cache = LRUCache(maxsize=4096)
+
+# Function to generate (or reuse) the option set of a (mean, sd, value_type, num_options, jump) tuple
+def cached_option_set(mean, sd, value_type, num_options=5, jump=5, only_positive=True):
+    key = (float(mean), float(sd), value_type, int(num_options), int(jump), only_positive)
+    options = option_set_cache.get(key)
+    if options is None:
+        options = tuple(generate_option_set(mean, sd, value_type, num_options=num_options, jump=jump, only_positive=only_positive))
+        option_set_cache.put(key, options)
+    return list(options)
+
+# Function to compute (or reuse) the normal distribution probabilities of many items, where only the cache misses go through normalize_probability_sets
+def cached_normalize_probability_sets(option_bounds, mean_sd_pairs, remove_diff_type="from_all_equally"):
+    keys = [(tuple(map(tuple, bounds)), float(mean), float(sd), remove_diff_type) for bounds, (mean, sd) in zip(option_bounds, mean_sd_pairs)]
+    resolved = {}
+    missing_keys = []
+    for key in keys:
+        if key not in resolved and key not in missing_keys:
+            probabilities = bin_probabilities_cache.get(key)
+            if probabilities is None:
+                missing_keys.append(key)
+            else:
+                resolved[key] = probabilities
+    if missing_keys:
+        for key, probabilities in zip(missing_keys, normalize_probability_sets([list(key[0]) for key in missing_keys], [(key[1], key[2]) for key in missing_keys], remove_diff_type)):
+            probabilities.flags.writeable = False # Shared by every later cache hit, so protect it from in-place changes
+            bin_probabilities_cache.put(key, probabilities)
+            resolved[key] = probabilities
+    return [resolved[key] for key in keys]
+
+# Function to report the hit/miss counters of the binning caches
+def binning_cache_info():
+    return {'option_sets': option_set_cache.info(), 'bin_probabilities': bin_probabilities_cache.info()}
+
+# Function to validate and normalise the agent inputs DataFrame, i.e. compile_profile_spec (the one validation path) serialised back to the input file layout
 def validate_and_normalize_input_data(df, remove_diff_type):
-    if df.empty:
-        return "Error: Input file is empty."
-    for index, row in df.iterrows():
-        if pd.notna(df.at[index, 'item_probability_set']): # Then parse input values
-            try:
-                mean, sd = parse_input_value(df.at[index, 'item_probability_set'])
-                if pd.isna(df.at[index, 'option_set']):
-                    options = generate_option_set(mean, sd, value_type=str(df.at[index, 'item_probability_set_type']), num_options=int(df.at[index, 'item_probability_set_n_options']), jump=int(df.at[index, 'item_probability_set_jumps']))
-                    df.at[index, 'option_set'] = ';'.join(map(str, options))
-                df = update_probability_distribution(df, index, mean, sd, remove_diff_type)
-            except ValueError as e:
-                return f"Error at row {index + 1}: {e}"
-        # Validate option_set
-        options = df.at[index, 'option_set'].split(';') if pd.notna(df.at[index, 'option_set']) else []
-        if not options:
-            return f"Error at row {index + 1}: 'option_set' must contain at least one option."
-        # Validate item_cross_probability_with_item_names
-        cross_items=[]
-        if pd.notna(df.at[index, 'item_cross_probability_with_item_names']):
-            cross_items = df.at[index, 'item_cross_probability_with_item_names'].split(';')
-            if not all(item in df['item_name'].unique() for item in cross_items):
-                return f"Error at row {index + 1}: 'item_cross_probability_with_item_names' must only include valid 'item_name' entries."
-            if len(cross_items) > 1:
-                return f"Error at row {index + 1}: 'item_cross_probability_with_item_names' should have one value but has {len(cross_items)}."
-        # Validate item_cross_probability_with_item_probabilities
-        if cross_items:
-            cross_probabilities = df.at[index, 'item_cross_probability_with_item_probabilities'].split(';') if pd.notna(df.at[index, 'item_cross_probability_with_item_probabilities']) else []
-            if cross_probabilities:
-                cross_options_lengths = [len(df[df['item_name'] == item]['option_set'].values[0].split(';')) for item in cross_items]
-                expected_length = len(options) * sum(cross_options_lengths)
-                if len(cross_probabilities) != expected_length:
-                    return f"Error at row {index + 1}: 'item_cross_probability_with_item_probabilities' should have {expected_length} values but has {len(cross_probabilities)}."
-                # Split cross_probabilities into sublists for each age group
-                sublists = [cross_probabilities[i:i + len(options)] for i in range(0, len(cross_probabilities), len(options))]
-                # Validate each sublist
-                for sublist in sublists:
-                    probability_values = [float(p) if p else 0.0 for p in sublist]
-                    if not np.isclose(sum(probability_values), 1.0) or any(p < 0 for p in probability_values):
-                        return f"Error at row {index + 1}: Each set of cross probabilities must be nonnegative and sum to 1."
-        # Validate individual item_probability_distribution
-        item_probabilities = df.at[index, 'item_probability_distribution'].split(';') if pd.notna(df.at[index, 'item_probability_distribution']) else []
-        if item_probabilities:
-            if len(item_probabilities) != len(options):
-                return f"Error at row {index + 1}: 'item_probability_distribution' must have {len(options)} values but has {len(item_probabilities)}."
-            probability_values = [float(p) if p else 0.0 for p in item_probabilities]
-            if not np.isclose(sum(probability_values), 1.0):
-                return f"Error at row {index + 1}: Item probabilities must all sum to 1."
-            if any(p < 0 for p in probability_values):
-                return f"Error at row {index + 1}: Item probabilities must all be nonnegative."
-    return df
+    spec = compile_profile_spec(df, remove_diff_type)
+    if isinstance(spec, str):
+        return spec
+    return spec.to_dataframe(source_df=df)
 
 # Function to
 def read_input_file(file_path, remove_diff_type, ):
     df = pd.read_excel(file_path)
-    # Preprocess and normalize the data
-    for index, row in df.iterrows():
-        # Check if the probability distribution is provided, if not, generate a uniform distribution
-        if pd.isna(row['item_probability_distribution']):
-            try:
-                options = row['option_set'].split(';')
-                uniform_probability = 1 / len(options)
-                df.at[index, 'item_probability_distribution'] = ';'.join([str(uniform_probability)] * len(options))
-            except:
-                pass
-    # Validate and normalize data
+    # Validate and normalize data (parsed once, see compile_profile_spec)
     validation_result = validate_and_normalize_input_data(df, remove_diff_type)
     if isinstance(validation_result, str) and validation_result.startswith("Error"):
         print(validation_result)
         return None
-    else:
-        df = validation_result
-    return df
+    return validation_result
 
 # Function to
 def parse_joint_probabilities(joint_probabilities_str, dimension_sizes):
@@ -190,59 +195,295 @@ def parse_joint_probabilities(joint_probabilities_str, dimension_sizes):
     joint_probabilities_matrix = np.reshape(probabilities, dimension_sizes)
     return joint_probabilities_matrix
 
-# Function to
-def generate_agent_profiles_with_dependencies(df, num_agents):
-    # Additional preprocessing to handle joint probabilities
+# Function to generate the agents one at a time, drawing the items of the compiled spec in dependency order (see CompiledProfileSpec.draw_order)
+def generate_agent_profiles_with_dependencies(df, num_agents, seed=None):
+    rng = random.Random(seed) # Own generator (rather than the global random module), so that a seeded run is reproducible
+    # Parse, validate and order the items once (rather than once per agent and item)
+    spec = df if isinstance(df, CompiledProfileSpec) else compile_profile_spec(df)
+    if isinstance(spec, str):
+        raise ValueError(spec)
     agents = []
     for _ in range(num_agents):
-        agent = {}
-        dependent_values = {}
-        for _, row in df.iterrows():
-            options = row['option_set'].split(';')
-            item_name = row['item_name']
-            if 'item_cross_probability_with_item_names' in row and not row['item_cross_probability_with_item_names'] != row['item_cross_probability_with_item_names']:
-                # Cross-dependency exists
-                cross_items = row['item_cross_probability_with_item_names'].split(';')
-                cross_options_lengths = [len(df[df['item_name'] == item]['option_set'].values[0].split(';')) for item in cross_items]
-                dimension_sizes = (len(options), sum(cross_options_lengths))
-                # Parse the joint probabilities
-                joint_probabilities_matrix = parse_joint_probabilities(row['item_cross_probability_with_item_probabilities'], dimension_sizes)
-                # Logic to select options based on joint probabilities
-                if all(dependency in dependent_values for dependency in cross_items):
-                    # All dependencies have been processed before
-                    dependent_indexes = [dependent_values[dependency] for dependency in cross_items]
-                    probabilities = joint_probabilities_matrix[:, dependent_indexes].flatten()
-                    choice = random.choices(options, weights=probabilities, k=1)[0]
-                else:
-                    # Fallback to individual probabilities if dependencies are not yet processed
-                    probabilities = row['item_probability_distribution'].split(';')
-                    probabilities = [float(p) if p else 0.0 for p in probabilities]
-                    choice = random.choices(options, weights=probabilities, k=1)[0]
+        codes = [None] * len(spec.items)
+        for position in spec.draw_order:
+            item = spec.items[position]
+            if item.parent_indices:
+                # Parents are always drawn before their children (whatever the row order of the input file), so the CPT row is known
+                probabilities = item.cpt[tuple(codes[parent_index] for parent_index in item.parent_indices)]
             else:
-                probabilities = row['item_probability_distribution'].split(';')
-                probabilities = [float(p) if p else 0.0 for p in probabilities]
-                choice = random.choices(options, weights=probabilities, k=1)[0]
-            agent[item_name] = choice
-            dependent_values[item_name] = options.index(choice)
-        agents.append(agent)
+                probabilities = item.probabilities
+            codes[position] = rng.choices(range(len(item.options)), weights=probabilities, k=1)[0]
+        # One entry per item, in the order of the input file
+        agents.append({item.item_name: item.options[code] for item, code in zip(spec.items, codes)})
     return agents
 
-# Function to
+# Define the compiled (i.e. parsed once) representation of a single item/row of the agent inputs file
+class CompiledProfileItem:
+    __slots__ = ('item_name', 'options', 'probabilities', 'cumulative', 'parent_names', 'parent_indices', 'cpt', 'joint_matrix', 'conditional_cumulative', 'probability_set',
+                 'clean_item_name', 'clean_options')
+
+    def __init__(self, item_name, options, probabilities, probability_set=None):
+        self.item_name = item_name
+        self.options = np.array(options, dtype=object)
+        self.probabilities = np.array(probabilities, dtype=np.float64)
+        self.cumulative = np.cumsum(self.probabilities)
+        self.parent_names = []
+        self.parent_indices = []
+        self.cpt = None # Conditional probability table, shape (len(parent 1 options), ..., len(parent k options), len(options))
+        self.joint_matrix = None # Shape (len(options), number of parent option combinations), column j holds the distribution given combination j
+        self.conditional_cumulative = None # Shape (number of parent option combinations, len(options)), row j is the cumulative of joint_matrix column j
+        self.probability_set = probability_set # The original "mean (SD = sd)" string, if any
+        # Cleaned labels (see clean_special_characters), computed once here so that generated agents need no per-cell cleaning
+        self.clean_item_name = replace_special_chars(item_name) if isinstance(item_name, str) else item_name
+        self.clean_options = np.array([replace_special_chars(option) if isinstance(option, str) else option for option in self.options], dtype=object)
+
+    def set_parents(self, parent_names, parent_indices, cpt):
+        # The parent option combinations are numbered with the first parent varying slowest (i.e. np.ravel_multi_index over the cpt's parent axes)
+        self.parent_names = list(parent_names)
+        self.parent_indices = list(parent_indices)
+        self.cpt = np.array(cpt, dtype=np.float64)
+        self.joint_matrix = self.cpt.reshape(-1, len(self.options)).T
+        self.conditional_cumulative = np.cumsum(self.cpt.reshape(-1, len(self.options)), axis=1)
+
+    def set_parent(self, parent_name, parent_index, joint_matrix):
+        self.set_parents([parent_name], [parent_index], np.asarray(joint_matrix).T)
+
+# Define the compiled agent inputs file, i.e. the structure consumed by the (batch) agent generators
+class CompiledProfileSpec:
+    __slots__ = ('items', 'item_index', 'levels')
+
+    def __init__(self, items):
+        self.items = list(items)
+        self.item_index = {item.item_name: position for position, item in enumerate(self.items)}
+        self.levels = None # Dependency levels (see compute_levels), set by compile_profile_spec once all parents are known
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def item_names(self):
+        return [item.item_name for item in self.items]
+
+    @property
+    def draw_order(self):
+        # Item positions in topological order, i.e. every item comes after all of its parents
+        return [position for level in self.levels for position in level]
+
+    def compute_levels(self):
+        # Topologically sort the dependency graph (Kahn's algorithm): level 0 holds the items without parents, and level k the items
+        # whose parents are all in levels < k, so that all items of a level can be drawn together
+        remaining_parents = {position: set(item.parent_indices) for position, item in enumerate(self.items)}
+        levels = []
+        while remaining_parents:
+            level = sorted(position for position, parents in remaining_parents.items() if not parents)
+            if not level:
+                cycle_items = [self.items[position].item_name for position in sorted(remaining_parents)]
+                raise ValueError(f"'item_cross_probability_with_item_names' contains a dependency cycle between: {', '.join(map(str, cycle_items))}")
+            for position in level:
+                del remaining_parents[position]
+            for parents in remaining_parents.values():
+                parents.difference_update(level)
+            levels.append(level)
+        self.levels = levels
+        return levels
+
+    def to_dataframe(self, source_df=None):
+        # Serialise back to the ';'-joined layout of the input file (e.g. for generate_agent_profiles_with_dependencies), carrying over the
+        # columns of source_df (the DataFrame the spec was compiled from) that aren't compiled, e.g. item_probability_set_type/_n_options/_jumps
+        rows = []
+        for item in self.items:
+            rows.append({
+                'item_name': item.item_name,
+                'option_set': ';'.join(map(str, item.options)),
+                'item_probability_distribution': ';'.join(map(str, item.probabilities.tolist())),
+                'item_cross_probability_with_item_names': ';'.join(item.parent_names) if item.parent_names else np.nan,
+                'item_cross_probability_with_item_probabilities': ';'.join(map(str, item.cpt.ravel().tolist())) if item.cpt is not None else np.nan,
+                'item_probability_set': item.probability_set if item.probability_set is not None else np.nan,
+            })
+        df = pd.DataFrame(rows)
+        if source_df is not None:
+            other_columns = [column for column in source_df.columns if column not in df.columns]
+            df = pd.concat([df, source_df[other_columns].reset_index(drop=True)], axis=1)
+            df = df[[column for column in source_df.columns if column in df.columns] + [column for column in df.columns if column not in source_df.columns]]
+        return df
+
+# Function to compile (parse, normalise and validate) the agent inputs DataFrame into a CompiledProfileSpec, parsing each row once
+def compile_profile_spec(df, remove_diff_type="from_all_equally"):
+    if df.empty:
+        return "Error: Input file is empty."
+    rows = list(zip(df.index, df.to_dict('records')))
+    parsed_rows = []
+    probability_set_positions, option_bounds, mean_sd_pairs = [], [], []
+    for position, (index, row) in enumerate(rows):
+        options = str(row['option_set']).split(';') if pd.notna(row['option_set']) else []
+        probability_set = row.get('item_probability_set')
+        if pd.notna(probability_set): # Then parse input values
+            try:
+                mean, sd = parse_input_value(probability_set)
+                if not options:
+                    options = list(map(str, cached_option_set(mean, sd, value_type=str(row['item_probability_set_type']), num_options=int(row['item_probability_set_n_options']), jump=int(row['item_probability_set_jumps']))))
+                bounds = [extract_range(option) for option in options]
+            except ValueError as e:
+                return f"Error at row {index + 1}: {e}"
+            if options:
+                probability_set_positions.append(position)
+                option_bounds.append(bounds)
+                mean_sd_pairs.append((mean, sd))
+        else:
+            probability_set = None
+        parsed_rows.append((options, probability_set))
+    # Normalise all "item_probability_set" rows in one pass (reusing the cached probabilities of any (options, mean, sd) seen before)
+    normalized_probabilities = dict(zip(probability_set_positions, cached_normalize_probability_sets(option_bounds, mean_sd_pairs, remove_diff_type)))
+    items = []
+    for position, ((index, row), (options, probability_set)) in enumerate(zip(rows, parsed_rows)):
+        # Validate option_set
+        if not options:
+            return f"Error at row {index + 1}: 'option_set' must contain at least one option."
+        # Validate individual item_probability_distribution (or generate a uniform distribution if it is not provided)
+        probabilities = normalized_probabilities.get(position)
+        if probabilities is None:
+            if pd.notna(row['item_probability_distribution']):
+                item_probabilities = str(row['item_probability_distribution']).split(';')
+                if len(item_probabilities) != len(options):
+                    return f"Error at row {index + 1}: 'item_probability_distribution' must have {len(options)} values but has {len(item_probabilities)}."
+                probabilities = np.array([float(p) if p else 0.0 for p in item_probabilities], dtype=np.float64)
+            else:
+                probabilities = np.full(len(options), 1 / len(options))
+        if not np.isclose(probabilities.sum(), 1.0):
+            return f"Error at row {index + 1}: Item probabilities must all sum to 1."
+        if (probabilities < 0).any():
+            return f"Error at row {index + 1}: Item probabilities must all be nonnegative."
+        items.append(CompiledProfileItem(row['item_name'], options, probabilities, probability_set))
+    spec = CompiledProfileSpec(items)
+    # Validate and compile item_cross_probability_with_item_names/probabilities (once all option sets are known)
+    for (index, row), item in zip(rows, spec.items):
+        if pd.isna(row.get('item_cross_probability_with_item_names')):
+            continue
+        cross_items = str(row['item_cross_probability_with_item_names']).split(';')
+        if not all(cross_item in spec.item_index for cross_item in cross_items):
+            return f"Error at row {index + 1}: 'item_cross_probability_with_item_names' must only include valid 'item_name' entries."
+        if len(set(cross_items)) != len(cross_items) or item.item_name in cross_items:
+            return f"Error at row {index + 1}: 'item_cross_probability_with_item_names' must not repeat an item or include the item itself."
+        if pd.isna(row.get('item_cross_probability_with_item_probabilities')):
+            continue
+        cross_probabilities = np.array([float(p) if p else 0.0 for p in str(row['item_cross_probability_with_item_probabilities']).split(';')], dtype=np.float64)
+        parent_indices = [spec.item_index[cross_item] for cross_item in cross_items]
+        parent_sizes = [len(spec.items[parent_index].options) for parent_index in parent_indices]
+        expected_length = len(item.options) * int(np.prod(parent_sizes))
+        if len(cross_probabilities) != expected_length:
+            return f"Error at row {index + 1}: 'item_cross_probability_with_item_probabilities' should have {expected_length} values but has {len(cross_probabilities)}."
+        # One block of len(options) probabilities per combination of parent options (first parent varying slowest), each block must be a distribution
+        blocks = cross_probabilities.reshape(-1, len(item.options))
+        if not np.allclose(blocks.sum(axis=1), 1.0) or (blocks < 0).any():
+            return f"Error at row {index + 1}: Each set of cross probabilities must be nonnegative and sum to 1."
+        item.set_parents(cross_items, parent_indices, blocks.reshape(*parent_sizes, len(item.options)))
+    # Order the items by their dependencies (so that spreadsheet row order does not matter), rejecting cycles
+    try:
+        spec.compute_levels()
+    except ValueError as e:
+        return f"Error: {e}"
+    return spec
+
+# Function to read the agent inputs file straight into a CompiledProfileSpec
+def read_profile_spec(file_path, remove_diff_type="from_all_equally"):
+    df = pd.read_excel(file_path)
+    spec = compile_profile_spec(df, remove_diff_type)
+    if isinstance(spec, str) and spec.startswith("Error"):
+        print(spec)
+        return None
+    return spec
+
+# Function to turn a seed (None, int, SeedSequence or Generator) into a SeedSequence, i.e. the root of a tree of independent random streams
+def as_seed_sequence(seed=None):
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        return seed.bit_generator.seed_seq
+    return np.random.SeedSequence(seed)
+
+# Function to derive an independent child stream of a seed for a given key path (e.g. ('block', 3) or ('stratum', 'Australia')),
+# so that each file, stratum or block of agents gets the same stream whatever else is generated in the run (and in whatever order)
+def child_seed_sequence(seed, *keys):
+    root = as_seed_sequence(seed)
+    spawn_key = tuple(key if isinstance(key, (int, np.integer)) and key >= 0 else zlib.crc32(str(key).encode('utf-8')) for key in keys)
+    return np.random.SeedSequence(root.entropy, spawn_key=tuple(root.spawn_key) + spawn_key)
+
+# Function to draw one categorical code per agent, where each agent has its own cumulative distribution (one row per agent)
+def draw_codes_from_cumulative_rows(cumulative_rows, rng, uniforms=None):
+    uniforms = rng.random(cumulative_rows.shape[0]) if uniforms is None else uniforms
+    thresholds = uniforms * cumulative_rows[:, -1]
+    codes = (cumulative_rows <= thresholds[:, None]).sum(axis=1)
+    return np.minimum(codes, cumulative_rows.shape[1] - 1)
+
+# Function to generate all agents in a batch, i.e. each item is drawn for all N agents in one vectorized step (the vectorized alternative to
+# generate_agent_profiles_with_dependencies, one column per 'item_name'; clean gives the clean_special_characters labels, as_category 'category' columns)
+def generate_agent_profiles_batch(spec, num_agents, seed=None, clean=False, as_category=False):
+    if isinstance(spec, pd.DataFrame):
+        spec = compile_profile_spec(spec)
+        if isinstance(spec, str):
+            raise ValueError(spec)
+    rng = np.random.default_rng(seed)
+    if spec.levels is None:
+        spec.compute_levels()
+    sampled_codes = [None] * len(spec.items)
+    # Draw the items level by level (parents always in an earlier level), with one block of uniforms per level
+    for level in spec.levels:
+        level_uniforms = rng.random((len(level), num_agents))
+        for item_uniforms, position in zip(level_uniforms, level):
+            item = spec.items[position]
+            if item.parent_indices:
+                # Gather the CPT row for each agent's already-sampled combination of parent options
+                parent_combinations = np.ravel_multi_index([sampled_codes[parent_index] for parent_index in item.parent_indices], item.cpt.shape[:-1])
+                codes = draw_codes_from_cumulative_rows(item.conditional_cumulative[parent_combinations], rng, uniforms=item_uniforms)
+            else:
+                codes = np.searchsorted(item.cumulative, item_uniforms * item.cumulative[-1], side='right')
+                codes = np.minimum(codes, len(item.cumulative) - 1)
+            sampled_codes[position] = codes
+    # One column per item, in the order of the input file
+    agents = {}
+    for item, codes in zip(spec.items, sampled_codes):
+        options, column_name = (item.clean_options, item.clean_item_name) if clean else (item.options, item.item_name)
+        if as_category and len(pd.unique(options)) == len(options):
+            agents[column_name] = pd.Categorical.from_codes(codes, categories=options)
+        elif as_category: # Duplicate option labels cannot be categories, so let pandas infer the (unique) categories instead
+            agents[column_name] = pd.Categorical(options[codes])
+        else:
+            agents[column_name] = options[codes]
+    return pd.DataFrame(agents)
+
+# Function to clean the special characters of a single option label or column name
+def replace_special_chars(text):
+    # Replace "/" with " or "
+    text = text.replace("/", " or ")
+    # Replace " (" with ", "
+    text = text.replace(" (", ", ")
+    # Replace ")" with ""
+    text = text.replace(")", "")
+    # Replace "-" with " to " if it is surrounded by numbers
+    text = re.sub(r'(\d+)-(\d+)', r'\1 to \2', text)
+    return text
+
+# Function to clean the special characters of a DataFrame's values and column names
+# Note: each column only holds a handful of distinct labels, so these are cleaned once per unique value (or category) rather than once per cell
 def clean_special_characters(df):
-    def replace_special_chars(text):
-        # Replace "/" with " or "
-        text = text.replace("/", " or ")
-        # Replace " (" with ", "
-        text = text.replace(" (", ", ")
-        # Replace ")" with ""
-        text = text.replace(")", "")
-        # Replace "-" with " to " if it is surrounded by numbers
-        text = re.sub(r'(\d+)-(\d+)', r'\1 to \2', text)
-        return text
-    # Clean the DataFrame values
-    cleaned_df = df.map(lambda x: replace_special_chars(x) if isinstance(x, str) else x)
+    cleaned_columns = {}
+    for position, col in enumerate(df.columns):
+        values = df.iloc[:, position]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            cleaned_categories = [replace_special_chars(x) if isinstance(x, str) else x for x in values.cat.categories]
+            if len(set(cleaned_categories)) == len(cleaned_categories):
+                cleaned_columns[position] = values.cat.rename_categories(cleaned_categories)
+            else: # Two labels clean to the same text, so these are merged into one category
+                cleaned_columns[position] = pd.Categorical(np.array(cleaned_categories + [np.nan], dtype=object)[values.cat.codes])
+        elif pd.api.types.is_object_dtype(values.dtype) or pd.api.types.is_string_dtype(values.dtype):
+            codes, uniques = pd.factorize(values)
+            cleaned_uniques = np.array([replace_special_chars(x) if isinstance(x, str) else x for x in uniques] + [np.nan], dtype=object)
+            cleaned_columns[position] = cleaned_uniques[codes] # Missing values have code -1, i.e. the trailing np.nan
+        else:
+            cleaned_columns[position] = values.to_numpy()
+    cleaned_df = pd.DataFrame(cleaned_columns, index=df.index)
     # Clean the column names
-    cleaned_df.columns = [replace_special_chars(col) for col in df.columns]
+    cleaned_df.columns = [replace_special_chars(col) if isinstance(col, str) else col for col in df.columns]
     return cleaned_df
 
 # Function to extract filename without extension
@@ -255,33 +496,248 @@ def extract_filename(filepath):
     else:
         return None
 
-##### ------ MAIN CODE - START ------- ####
-
-## ------ SECTION 1: Generate synthetic data using manually-designed agent inputs file ------ ##
-input_file_paths = glob.glob('sample_profiles_input_'+'*_v2.xlsx')
-
-# Read the file into a DataFrame
-#input_file_path = 'sample_profile_generation_input_v5.xlsx'
-#input_file_path = 'Ana_Maria_Matrix_for_agent_generation_updated_SB_31May2024.xlsx' # NOTE: old input file type used (v3)
-#input_file_path = 'sample_profiles_input_DOOTSON_STUDY_v2.xlsx'
-
-for input_file_path in input_file_paths:
-    if os.path.exists(input_file_path[:-5] + '_agents_output.xlsx'):
-        continue
+# Function to generate agents start..stop-1 of a seeded population, where every block of block_size agents has its own random stream
+# Note: any range of agents is therefore the same whether the population is generated at once, in chunks or across workers
+def generate_agent_profiles_blocked(spec, start, stop, seed=None, block_size=10000, clean=False, as_category=False):
+    if isinstance(spec, pd.DataFrame):
+        spec = compile_profile_spec(spec)
+        if isinstance(spec, str):
+            raise ValueError(spec)
+    root_seed = as_seed_sequence(seed)
+    agents_blocks = []
+    for block in range(start // block_size, -(-stop // block_size)):
+        agents_block = generate_agent_profiles_batch(spec, block_size, seed=child_seed_sequence(root_seed, 'block', block), clean=clean, as_category=as_category)
+        block_start = block * block_size
+        agents_blocks.append(agents_block.iloc[max(start - block_start, 0):min(stop - block_start, block_size)])
+    if not agents_blocks:
+        return generate_agent_profiles_batch(spec, 0, clean=clean, as_category=as_category)
+    return pd.concat(agents_blocks, ignore_index=True) if len(agents_blocks) > 1 else agents_blocks[0].reset_index(drop=True)
+
+# Function to generate agents in fixed-size chunks (i.e. a generator), so that peak memory depends on chunk_size rather than num_agents
+# Note: chunks are built from seeded blocks (see generate_agent_profiles_blocked), so a seeded run gives the same agents for any chunk_size
+def iter_agent_profile_chunks(spec, num_agents, chunk_size=100000, seed=None, clean=True, as_category=False, block_size=10000):
+    if isinstance(spec, pd.DataFrame):
+        spec = compile_profile_spec(spec)
+        if isinstance(spec, str):
+            raise ValueError(spec)
+    root_seed = as_seed_sequence(seed)
+    for start in range(0, num_agents, chunk_size):
+        yield generate_agent_profiles_blocked(spec, start, min(start + chunk_size, num_agents), seed=root_seed, block_size=block_size, clean=clean, as_category=as_category)
+
+# Function to stream agents chunk-by-chunk to a csv or parquet (needs pyarrow) file, e.g. for populations that are too large for memory or for xlsx
+def write_agent_profiles_stream(spec, num_agents, output_path, chunk_size=100000, seed=None, clean=True, block_size=10000):
+    file_format = os.path.splitext(output_path)[1].lower()
+    if file_format not in ('.csv', '.parquet'):
+        raise ValueError(f"Invalid output file type: {file_format} (expected '.csv' or '.parquet')")
+    if file_format == '.parquet':
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing agents to parquet requires pyarrow (e.g. 'poetry add pyarrow'), or use a '.csv' output_path instead.")
+    num_written = 0
+    parquet_writer = None
+    try:
+        for agents_chunk in iter_agent_profile_chunks(spec, num_agents, chunk_size=chunk_size, seed=seed, clean=clean, block_size=block_size):
+            if file_format == '.csv':
+                agents_chunk.to_csv(output_path, mode='w' if num_written == 0 else 'a', header=(num_written == 0), index=False, encoding='utf-8')
+            else:
+                table = pa.Table.from_pandas(agents_chunk, preserve_index=False)
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(output_path, table.schema)
+                parquet_writer.write_table(table)
+            num_written += len(agents_chunk)
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+    return num_written
+
+# Function to generate (and save) the agents for a single input file, skipping it if its output already exists (returns the file's status and timings)
+def generate_agents_for_input_file(input_file_path, num_agents=500, seed=None, remove_diff_type="from_all_equally", chunk_size=100000, block_size=10000):
+    start_time = time.perf_counter()
+    result = {'input_file_path': input_file_path, 'output_file_path': None, 'status': 'skipped', 'num_agents': 0, 'seconds': 0.0}
+    for output_file_path in (input_file_path[:-5] + '_agents_output.xlsx', input_file_path[:-5] + '_agents_output.csv'):
+        if os.path.exists(output_file_path):
+            result['output_file_path'] = output_file_path
+            return result
+    input_data = read_profile_spec(file_path=input_file_path, remove_diff_type=remove_diff_type)
+    block_size = max(1, min(num_agents, block_size))
+    if input_data is None:
+        result['status'] = 'error'
+    elif num_agents > chunk_size:
+        # Stream very large populations to csv in chunks instead (xlsx caps at ~1M rows and the full population never sits in memory)
+        result['output_file_path'] = input_file_path[:-5] + '_agents_output.csv'
+        result['num_agents'] = write_agent_profiles_stream(input_data, num_agents, result['output_file_path'], chunk_size=chunk_size, seed=seed, block_size=block_size)
+        result['status'] = 'generated'
     else:
-        input_data = read_input_file(file_path=input_file_path, remove_diff_type="from_all_equally")
-        # Example usage
-        num_agents = 500
-        agents_data = generate_agent_profiles_with_dependencies(input_data, num_agents)
-        # Convert agents data to DataFrame and save to xlsx
-        agents_df = pd.DataFrame(agents_data)
-        agents_df = clean_special_characters(agents_df)
-        agents_df.to_excel(input_file_path[:-5] + '_agents_output.xlsx', index=False)
-        #agents_df.columns # (OPTIONAL) Check column names
-
-
-
-## ------ SECTION 2: Generate synthetic data using existing agent inputs file ------ ##
+        agents_df = generate_agent_profiles_blocked(input_data, 0, num_agents, seed=seed, block_size=block_size, clean=True) # Same agents as the streamed (csv) path for this seed
+        result['output_file_path'] = input_file_path[:-5] + '_agents_output.xlsx'
+        agents_df.to_excel(result['output_file_path'], index=False)
+        result['num_agents'] = len(agents_df)
+        result['status'] = 'generated'
+    result['seconds'] = time.perf_counter() - start_time
+    return result
+
+# Function to generate the agents for many input files at once, one input file per worker process
+# Note: each file's seed stream is keyed on its path relative to input_root (default: the files' common folder), so a file's agents don't depend on
+# the worker or the number of workers, and same-named files in different folders get different agents
+def run_profile_generation_parallel(input_file_paths, num_agents=500, master_seed=None, max_workers=None, remove_diff_type="from_all_equally", chunk_size=100000, input_root=None):
+    root_seed = as_seed_sequence(master_seed)
+    print(f"Master seed (entropy): {root_seed.entropy}") # Pass this back in as master_seed to reproduce the run
+    if input_root is None and input_file_paths:
+        input_root = os.path.commonpath([os.path.dirname(os.path.abspath(input_file_path)) for input_file_path in input_file_paths])
+    start_time = time.perf_counter()
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for input_file_path in input_file_paths:
+            file_seed = child_seed_sequence(root_seed, os.path.relpath(os.path.abspath(input_file_path), input_root).replace(os.sep, '/'))
+            future = executor.submit(generate_agents_for_input_file, input_file_path, num_agents, file_seed, remove_diff_type, chunk_size)
+            futures[future] = input_file_path
+        for future in as_completed(futures):
+            input_file_path = futures[future]
+            try:
+                results[input_file_path] = future.result()
+            except Exception as e:
+                results[input_file_path] = {'input_file_path': input_file_path, 'output_file_path': None, 'status': 'error', 'num_agents': 0, 'seconds': 0.0}
+                print(f"Error generating agents for {input_file_path}: {e}")
+            result = results[input_file_path]
+            print(f"{result['status']}: {input_file_path} ({result['num_agents']} agents in {result['seconds']:.2f}s)")
+    print(f"Finished {len(results)} input files in {time.perf_counter() - start_time:.2f}s")
+    return pd.DataFrame([results[input_file_path] for input_file_path in input_file_paths])
+
+# Function to compute the exact joint distribution of some items of a CompiledProfileSpec, by chaining the CPTs of the items and all their ancestors
+def spec_joint_distribution(spec, positions, max_joint_size=10**7):
+    if spec.levels is None:
+        spec.compute_levels()
+    # Collect the items and all their ancestors
+    ancestors, pending = set(), list(positions)
+    while pending:
+        position = pending.pop()
+        if position not in ancestors:
+            ancestors.add(position)
+            pending.extend(spec.items[position].parent_indices)
+    joint, joint_axes = np.ones(()), []
+    for position in [position for position in spec.draw_order if position in ancestors]: # Parents before children
+        item = spec.items[position]
+        parents = item.parent_indices
+        if np.prod([len(spec.items[axis].options) for axis in joint_axes + [position]], dtype=np.float64) > max_joint_size:
+            raise ValueError(f"The joint distribution of {len(ancestors)} items is too large to compute exactly (more than {max_joint_size} cells).")
+        if parents:
+            conditional = item.cpt / item.cpt.sum(axis=-1, keepdims=True)
+            joint = np.einsum(joint, joint_axes, conditional, parents + [position], joint_axes + [position])
+        else:
+            joint = np.multiply.outer(joint, item.probabilities / item.probabilities.sum())
+        joint_axes.append(position)
+    # Sum out the ancestors that were not asked for, in the order asked for
+    return np.einsum(joint, joint_axes, list(positions))
+
+# Function to compute each item's marginal distribution implied by a CompiledProfileSpec (as drawn by generate_agent_profiles_batch)
+def spec_marginal_distributions(spec, clean=False, max_joint_size=10**7):
+    if spec.levels is None:
+        spec.compute_levels()
+    item_probabilities = {}
+    for position in spec.draw_order: # Parents before children
+        item = spec.items[position]
+        parents = item.parent_indices
+        if not parents:
+            probabilities = item.probabilities / item.probabilities.sum()
+        else:
+            conditional = item.cpt / item.cpt.sum(axis=-1, keepdims=True)
+            # Mix the conditional distributions by the parents' distribution (their exact joint distribution, as parents may depend on each other)
+            parent_distribution = item_probabilities[parents[0]] if len(parents) == 1 else spec_joint_distribution(spec, parents, max_joint_size=max_joint_size)
+            probabilities = np.tensordot(parent_distribution, conditional, axes=len(parents))
+        item_probabilities[position] = probabilities
+    # One marginal distribution per item, in the order of the input file
+    marginals = {}
+    for position, item in enumerate(spec.items):
+        options = item.clean_options if clean else item.options
+        marginal = pd.Series(item_probabilities[position], index=pd.Index(options), name=item.clean_item_name if clean else item.item_name).groupby(level=0, sort=False).sum()
+        marginals[marginal.name] = marginal
+    return marginals
+
+# Define the online fidelity tracker, i.e. running counts of the generated agents' options, compared to target marginal distributions after every batch
+class OnlineFidelityTracker:
+    __slots__ = ('targets', 'counts', 'unknown_counts', 'num_agents', 'history', 'best_distance', 'drift_threshold')
+
+    def __init__(self, targets, drift_threshold=None):
+        # targets: {column: pd.Series of target probabilities indexed by option}; drift_threshold: flag drift when the largest distance rises this far above its best so far
+        self.targets = {col: target / target.sum() for col, target in targets.items()}
+        self.counts = {col: np.zeros(len(target), dtype=np.int64) for col, target in self.targets.items()}
+        self.unknown_counts = {col: 0 for col in self.targets} # Generated options that are not in the target at all
+        self.num_agents = 0
+        self.history = []
+        self.best_distance = np.inf
+        self.drift_threshold = drift_threshold
+
+    @classmethod
+    def from_spec(cls, spec, clean=False, drift_threshold=None):
+        return cls(spec_marginal_distributions(spec, clean=clean), drift_threshold=drift_threshold)
+
+    @classmethod
+    def from_data(cls, data, column_names, drift_threshold=None):
+        return cls({col: data[col].value_counts(normalize=True) for col in column_names}, drift_threshold=drift_threshold)
+
+    def update(self, agents_batch):
+        # Add the batch's counts (one get_indexer + bincount per column), then record the distances after this batch
+        batch_unknown = 0
+        for col, target in self.targets.items():
+            codes = target.index.get_indexer(agents_batch[col])
+            self.counts[col] += np.bincount(codes[codes >= 0], minlength=len(target))
+            batch_unknown += int((codes < 0).sum())
+            self.unknown_counts[col] += int((codes < 0).sum())
+        self.num_agents += len(agents_batch)
+        distances = self.distances()
+        max_distance = max(distances.values()) if distances else 0.0
+        drift = self.drift_threshold is not None and max_distance > self.best_distance + self.drift_threshold
+        # Options that are not in the target flag drift for the batch they appear in only (unknown_counts keeps the running totals)
+        drift = drift or batch_unknown > 0
+        self.best_distance = min(self.best_distance, max_distance)
+        self.history.append({'num_agents': self.num_agents, 'max_tvd': max_distance, 'drift': drift, 'unknown_options': batch_unknown, **{f'tvd: {col}': distance for col, distance in distances.items()}})
+        return distances
+
+    def distances(self):
+        # Total-variation distance between each column's running (observed) distribution and its target
+        distances = {}
+        for col, target in self.targets.items():
+            observed_total = self.counts[col].sum() + self.unknown_counts[col]
+            if observed_total == 0:
+                distances[col] = 1.0
+                continue
+            distances[col] = 0.5 * (np.abs(self.counts[col] / observed_total - target.to_numpy()).sum() + self.unknown_counts[col] / observed_total)
+        return distances
+
+    def within_tolerance(self, tolerance):
+        return bool(self.history) and self.history[-1]['max_tvd'] <= tolerance
+
+    @property
+    def drift(self):
+        return bool(self.history) and self.history[-1]['drift']
+
+    def history_dataframe(self):
+        return pd.DataFrame(self.history)
+
+# Function to generate agents batch by batch until their marginal distributions are within a tolerance of the spec's (or of the tracker's targets),
+# between min_agents and max_agents, returning (agents, tracker)
+def generate_agent_profiles_until_converged(spec, tolerance=0.01, batch_size=10000, max_agents=1000000, min_agents=0, seed=None, clean=False, tracker=None, stop_on_drift=False):
+    if isinstance(spec, pd.DataFrame):
+        spec = compile_profile_spec(spec)
+        if isinstance(spec, str):
+            raise ValueError(spec)
+    tracker = tracker if tracker is not None else OnlineFidelityTracker.from_spec(spec, clean=clean)
+    rng = np.random.default_rng(seed)
+    agents_batches = []
+    while tracker.num_agents < max_agents:
+        agents_batch = generate_agent_profiles_batch(spec, min(batch_size, max_agents - tracker.num_agents), seed=rng, clean=clean)
+        agents_batches.append(agents_batch)
+        tracker.update(agents_batch)
+        if stop_on_drift and tracker.drift:
+            print(f"Drift flagged after {tracker.num_agents} agents (largest distance {tracker.history[-1]['max_tvd']:.4f})")
+            break
+        if tracker.num_agents >= min_agents and tracker.within_tolerance(tolerance):
+            break
+    agents_df = pd.concat(agents_batches, ignore_index=True) if agents_batches else pd.DataFrame()
+    return agents_df, tracker
 
 # Function to compute the joint probabilities of the specified columns in the dataset
 def create_joint_probability_matrix(data, column_names):
@@ -296,51 +752,296 @@ def create_joint_probability_matrix(data, column_names):
     joint_probability_matrix = joint_frequency.unstack(fill_value=0)
     return joint_probability_matrix
 
-# Function that uses the joint probability matrix to generate a sample population of agents
-def generate_sample_population(joint_prob_matrix, n):
-    flat_probs = joint_prob_matrix.values.flatten()
-    flat_probs /= flat_probs.sum()
-    sample_indices = np.random.choice(len(flat_probs), size=n, p=flat_probs)
-    # Convert flat indices to multi-dimensional indices
-    row_indices, col_indices = np.unravel_index(sample_indices, joint_prob_matrix.shape)
-    sampled_agents = []
-    for row_idx, col_idx in zip(row_indices, col_indices):
-        # Fetch the corresponding categories for each index
-        row_values = joint_prob_matrix.index[row_idx]  # This will be a tuple for multi-level indices
-        col_value = joint_prob_matrix.columns[col_idx]
-        # Combine row values and column value(s) into a single list
-        agent = list(row_values) + [col_value]
-        sampled_agents.append(agent)
+# Define the sparse joint distribution of a set of columns, i.e. only the observed combinations (as code tuples) and their probabilities
+# Note: memory and sampling time scale with the number of distinct observed combinations, rather than the product of the column cardinalities (as with create_joint_probability_matrix)
+class SparseJointDistribution:
+    __slots__ = ('column_names', 'categories', 'codes', 'probabilities', 'cumulative', 'alias_table')
+
+    def __init__(self, column_names, categories, codes, weights):
+        self.column_names = list(column_names)
+        self.categories = list(categories) # One pd.Index of labels per column
+        self.codes = np.asarray(codes) # Shape (number of observed combinations, number of columns), the code of each column's label
+        weights = np.asarray(weights, dtype=np.float64)
+        self.probabilities = weights / weights.sum()
+        self.cumulative = np.cumsum(self.probabilities)
+        self.alias_table = None # Built on first use by sample(method="alias")
+
+    def __len__(self):
+        return len(self.probabilities)
+
+    @classmethod
+    def from_data(cls, data, column_names, weight_column=None):
+        # Factorize each column once (missing values get code -1 and, as with value_counts, those rows are dropped)
+        if isinstance(data, str):
+            data = pd.read_csv(data) if data.endswith('.csv') else pd.read_excel(data)
+        categories, column_codes = [], []
+        for col in column_names:
+            codes, uniques = pd.factorize(data[col], sort=True)
+            column_codes.append(codes)
+            categories.append(pd.Index(uniques, name=col))
+        codes = np.column_stack(column_codes) if column_codes else np.empty((len(data), 0), dtype=np.int64)
+        keep = (codes >= 0).all(axis=1)
+        codes = codes[keep]
+        # Group identical code tuples, i.e. one row per observed combination (sorted by the first column, then the second, ...)
+        dimension_sizes = [max(len(column_categories), 1) for column_categories in categories]
+        if np.prod(np.array(dimension_sizes, dtype=np.float64)) < 2 ** 62:
+            # The tuples fit in one int64 key each, which is much faster to group than rows
+            keys, inverse = np.unique(np.ravel_multi_index(codes.T, dimension_sizes), return_inverse=True)
+            combination_codes = np.column_stack(np.unravel_index(keys, dimension_sizes)) if len(column_names) else np.empty((len(keys), 0), dtype=np.int64)
+        else:
+            combination_codes, inverse = np.unique(codes, axis=0, return_inverse=True)
+        inverse = np.asarray(inverse).ravel()
+        if weight_column is None:
+            weights = np.bincount(inverse, minlength=len(combination_codes))
+        else:
+            weights = np.bincount(inverse, weights=np.asarray(data[weight_column], dtype=np.float64)[keep], minlength=len(combination_codes))
+        smallest_dtype = np.min_scalar_type(max(int(combination_codes.max(initial=0)), 1)) # E.g. uint8 for columns with < 256 categories
+        return cls(column_names, categories, combination_codes.astype(smallest_dtype), weights)
+
+    def draw_indices(self, n, rng, method="inverse"):
+        if method == "alias":
+            if self.alias_table is None:
+                self.alias_table = build_alias_table(self.probabilities)
+            return draw_alias_indices(self.alias_table, n, rng)
+        elif method == "inverse":
+            indices = np.searchsorted(self.cumulative, rng.random(n) * self.cumulative[-1], side='right')
+            return np.minimum(indices, len(self.cumulative) - 1)
+        raise ValueError(f"Invalid sampling method: {method} (expected 'inverse' or 'alias')")
+
+    def sample(self, n, seed=None, method="inverse", as_category=False):
+        rng = np.random.default_rng(seed)
+        indices = self.draw_indices(n, rng, method=method)
+        sampled_codes = self.codes[indices]
+        if as_category: # No per-agent labels at all, just the sampled codes (much faster to build for many columns)
+            sample_df = pd.DataFrame({position: pd.Categorical.from_codes(sampled_codes[:, position], categories=self.categories[position]) for position in range(len(self.column_names))})
+        else:
+            sample_df = pd.DataFrame({position: np.asarray(self.categories[position], dtype=object)[sampled_codes[:, position]] for position in range(len(self.column_names))})
+        sample_df.columns = self.column_names
+        return sample_df
+
+    def to_series(self):
+        # Observed combinations only, in the same layout as value_counts(normalize=True)
+        index = pd.MultiIndex(levels=self.categories, codes=[self.codes[:, position] for position in range(len(self.column_names))], names=self.column_names)
+        return pd.Series(self.probabilities, index=index, name='proportion').sort_values(ascending=False)
+
+    def to_dense(self):
+        # The equivalent (dense) create_joint_probability_matrix output, only advisable for a few low-cardinality columns
+        return self.to_series().unstack(fill_value=0)
+
+# Function to compute the sparse joint distribution of the specified columns in the dataset (see SparseJointDistribution)
+def create_sparse_joint_distribution(data, column_names, weight_column=None):
+    return SparseJointDistribution.from_data(data, column_names, weight_column=weight_column)
+
+# Function to rake (iterative proportional fitting) the weights of a SparseJointDistribution, so that its marginals match target marginals
+# (e.g. census age x sex, optionally by country) while keeping the source's associations between all other columns
+# Note: margins holds one (columns, targets) or (columns, targets, within_columns) tuple per margin, where targets is indexed by the cells' labels (cells
+# missing from it get 0) and within_columns (e.g. 'country_name') makes the targets proportions within each of its groups
+def rake_joint_distribution(joint, margins, max_iterations=100, tolerance=1e-6):
+    weights = joint.probabilities.copy()
+    compiled_margins = []
+    unreachable_target = 0.0
+    for margin in margins:
+        columns, targets = margin[0], margin[1]
+        within_columns = margin[2] if len(margin) > 2 and margin[2] is not None else []
+        columns = [columns] if isinstance(columns, str) else list(columns)
+        within_columns = [within_columns] if isinstance(within_columns, str) else list(within_columns)
+        positions = [joint.column_names.index(col) for col in columns]
+        # Number the margin's observed cells once (one code per combination of the margin columns' codes)
+        cell_keys = np.ravel_multi_index([joint.codes[:, position].astype(np.int64) for position in positions], [len(joint.categories[position]) for position in positions])
+        cell_keys, cell_of_combination = np.unique(cell_keys, return_inverse=True)
+        cell_codes = np.unravel_index(cell_keys, [len(joint.categories[position]) for position in positions])
+        # Align the targets to the observed cells (through each column's category codes)
+        target_index = targets.index if isinstance(targets.index, pd.MultiIndex) else pd.MultiIndex.from_arrays([targets.index])
+        target_codes = [joint.categories[position].get_indexer(target_index.get_level_values(level)) for level, position in enumerate(positions)]
+        target_values = targets.to_numpy(dtype=np.float64)
+        known = np.all([codes >= 0 for codes in target_codes], axis=0)
+        target_keys = np.ravel_multi_index([codes[known] for codes in target_codes], [len(joint.categories[position]) for position in positions])
+        cell_targets = np.zeros(len(cell_keys), dtype=np.float64)
+        matched = np.isin(target_keys, cell_keys)
+        np.add.at(cell_targets, np.searchsorted(cell_keys, target_keys[matched]), target_values[known][matched])
+        # Target mass on cells that do not occur in the source at all cannot be reached by reweighting
+        unreachable_target = max(unreachable_target, (target_values.sum() - cell_targets.sum()) / target_values.sum())
+        if within_columns:
+            # Group of each cell, i.e. the combination of its within_columns codes
+            group_keys = np.ravel_multi_index([cell_codes[columns.index(col)] for col in within_columns], [len(joint.categories[joint.column_names.index(col)]) for col in within_columns])
+            _, group_of_cell = np.unique(group_keys, return_inverse=True)
+            group_target_totals = np.bincount(group_of_cell, weights=cell_targets)
+            cell_targets = np.divide(cell_targets, group_target_totals[group_of_cell], out=np.zeros_like(cell_targets), where=group_target_totals[group_of_cell] > 0)
+        else:
+            group_of_cell = None
+            cell_targets = cell_targets / cell_targets.sum()
+        compiled_margins.append((np.asarray(cell_of_combination).ravel(), cell_targets, group_of_cell))
+    max_error = np.inf
+    for iteration in range(1, max_iterations + 1):
+        for cell_of_combination, cell_targets, group_of_cell in compiled_margins:
+            current = np.bincount(cell_of_combination, weights=weights, minlength=len(cell_targets))
+            if group_of_cell is not None: # Targets are shares within each group, so scale them by the group's current total
+                desired = cell_targets * np.bincount(group_of_cell, weights=current)[group_of_cell]
+            else:
+                desired = cell_targets * current.sum()
+            factors = np.divide(desired, current, out=np.zeros_like(current), where=current > 0)
+            weights = weights * factors[cell_of_combination]
+        weights = weights / weights.sum()
+        # Largest gap between any margin cell and its target (as proportions of the whole population)
+        max_error = 0.0
+        for cell_of_combination, cell_targets, group_of_cell in compiled_margins:
+            current = np.bincount(cell_of_combination, weights=weights, minlength=len(cell_targets))
+            desired = cell_targets * np.bincount(group_of_cell, weights=current)[group_of_cell] if group_of_cell is not None else cell_targets
+            max_error = max(max_error, np.abs(current - desired).max())
+        if max_error <= tolerance:
+            break
+    raked = SparseJointDistribution(joint.column_names, joint.categories, joint.codes, weights)
+    return raked, {'iterations': iteration, 'max_error': float(max_error), 'converged': bool(max_error <= tolerance), 'unreachable_target': float(unreachable_target)}
+
+# Function to build the alias table (Vose's alias method) of a categorical distribution, so that each later draw costs O(1) whatever the number of categories
+# --> Returns (acceptance probabilities, alias indices)
+def build_alias_table(probabilities):
+    probabilities = np.asarray(probabilities, dtype=np.float64).ravel()
+    num_categories = len(probabilities)
+    scaled = probabilities * (num_categories / probabilities.sum())
+    acceptance = np.ones(num_categories, dtype=np.float64)
+    alias = np.arange(num_categories, dtype=np.int64)
+    small = list(np.flatnonzero(scaled < 1.0))
+    large = list(np.flatnonzero(scaled >= 1.0))
+    while small and large:
+        small_idx, large_idx = small.pop(), large.pop()
+        acceptance[small_idx] = scaled[small_idx]
+        alias[small_idx] = large_idx
+        scaled[large_idx] -= 1.0 - scaled[small_idx]
+        if scaled[large_idx] < 1.0:
+            small.append(large_idx)
+        else:
+            large.append(large_idx)
+    # Whatever is left (up to rounding error) keeps acceptance 1, i.e. always returns itself
+    return acceptance, alias
+
+# Function to draw n category indices from an alias table (see build_alias_table)
+def draw_alias_indices(alias_table, n, rng):
+    acceptance, alias = alias_table
+    indices = rng.integers(len(acceptance), size=n)
+    return np.where(rng.random(n) < acceptance[indices], indices, alias[indices])
+
+# Function to look up the row and column labels of sampled (flat) cells of a joint probability matrix, i.e. one array per index/column level
+def joint_matrix_labels_from_flat_indices(joint_prob_matrix, flat_indices):
+    row_indices, col_indices = np.unravel_index(flat_indices, joint_prob_matrix.shape)
+    sampled_labels = []
+    for axis_labels, positions in ((joint_prob_matrix.index, row_indices), (joint_prob_matrix.columns, col_indices)):
+        if isinstance(axis_labels, pd.MultiIndex):
+            # Take each level's codes at the sampled positions, then the level values at those codes (code -1 is a missing value)
+            for level, level_codes in zip(axis_labels.levels, axis_labels.codes):
+                sampled_labels.append(level.take(np.asarray(level_codes)[positions], allow_fill=True, fill_value=np.nan))
+        else:
+            sampled_labels.append(axis_labels.take(positions))
     # The column names consist of the row index names and column index names
-    column_names = joint_prob_matrix.index.names + joint_prob_matrix.columns.names
-    sample_df = pd.DataFrame(sampled_agents, columns=column_names)
+    column_names = list(joint_prob_matrix.index.names) + list(joint_prob_matrix.columns.names)
+    sample_df = pd.DataFrame({position: np.asarray(labels) for position, labels in enumerate(sampled_labels)})
+    sample_df.columns = column_names
+    return sample_df
+
+# Function that uses the joint probability matrix (or a SparseJointDistribution) to generate a sample population of agents
+# --> method is "inverse" (inverse-CDF draws) or "alias" (see build_alias_table), and a prebuilt alias_table can be reused across calls
+def generate_sample_population(joint_prob_matrix, n, seed=None, method="inverse", alias_table=None):
+    if isinstance(joint_prob_matrix, SparseJointDistribution):
+        return joint_prob_matrix.sample(n, seed=seed, method=method)
+    rng = np.random.default_rng(seed)
+    flat_probs = np.asarray(joint_prob_matrix.values, dtype=np.float64).ravel() # Copy, so that joint_prob_matrix itself is left untouched
+    if alias_table is not None or method == "alias":
+        if alias_table is None:
+            alias_table = build_alias_table(flat_probs)
+        sample_indices = draw_alias_indices(alias_table, n, rng)
+    elif method == "inverse":
+        cumulative = np.cumsum(flat_probs)
+        sample_indices = np.searchsorted(cumulative, rng.random(n) * cumulative[-1], side='right')
+        sample_indices = np.minimum(sample_indices, len(cumulative) - 1)
+    else:
+        raise ValueError(f"Invalid sampling method: {method} (expected 'inverse' or 'alias')")
+    # Convert flat indices to the corresponding categories of each index/column level
+    return joint_matrix_labels_from_flat_indices(joint_prob_matrix, sample_indices)
+
+# Function to generate many replicate sample populations from the same joint probability matrix, building its alias table only once (stacked, with a 'Replicate' column)
+def generate_sample_population_replicates(joint_prob_matrix, n, num_replicates, seed=None):
+    rng = np.random.default_rng(seed)
+    alias_table = build_alias_table(joint_prob_matrix.values)
+    sample_indices = draw_alias_indices(alias_table, n * num_replicates, rng)
+    sample_df = joint_matrix_labels_from_flat_indices(joint_prob_matrix, sample_indices)
+    sample_df['Replicate'] = np.repeat(np.arange(num_replicates), n)
+    return sample_df
+
+# Function to generate a sample population for every stratum (e.g. country) in one pass, with n_samples agents per stratum (or a {stratum: n} dictionary)
+# Note: all strata's joint distributions come from one grouping of the (stratum, columns of interest) combinations, and all strata are drawn in one vectorized step
+def generate_stratified_sample_populations(df, strata_cols, columns_of_interest, n_samples, seed=None, weight_column=None, as_category=False, margins=None):
+    strata_cols = [strata_cols] if isinstance(strata_cols, str) else list(strata_cols)
+    columns_of_interest = [col for col in columns_of_interest if col not in strata_cols]
+    # One joint distribution over (strata, columns of interest), whose observed combinations are sorted by stratum first
+    joint = SparseJointDistribution.from_data(df, strata_cols + columns_of_interest, weight_column=weight_column)
+    if margins:
+        joint, raking_info = rake_joint_distribution(joint, margins)
+        if not raking_info['converged']:
+            print(f"Warning: raking did not converge after {raking_info['iterations']} iterations (largest margin error {raking_info['max_error']:.2e})")
+    num_strata_cols = len(strata_cols)
+    stratum_starts = np.flatnonzero(np.r_[True, (np.diff(joint.codes[:, :num_strata_cols].astype(np.int64), axis=0) != 0).any(axis=1)])
+    stratum_ends = np.r_[stratum_starts[1:], len(joint)]
+    stratum_of_combination = np.repeat(np.arange(len(stratum_starts)), stratum_ends - stratum_starts)
+    # Cumulative probabilities within each stratum (each ending at exactly 1), shifted by the stratum number so that one searchsorted serves all strata
+    cumulative_weights = np.cumsum(joint.probabilities)
+    stratum_totals = np.add.reduceat(joint.probabilities, stratum_starts)
+    weights_before_stratum = cumulative_weights[stratum_starts] - joint.probabilities[stratum_starts]
+    if (stratum_totals <= 0).any(): # Only possible after raking a stratum's margin cells to zero targets
+        raise ValueError("Every stratum needs a positive total weight; check the raking margins for strata with zero targets.")
+    within_cumulative = (cumulative_weights - weights_before_stratum[stratum_of_combination]) / stratum_totals[stratum_of_combination]
+    within_cumulative = np.minimum(within_cumulative, 1.0) # Rounding can push values before a stratum's end past 1, i.e. into the next stratum
+    within_cumulative[stratum_ends - 1] = 1.0
+    global_cumulative = stratum_of_combination + within_cumulative
+    # Number of agents per stratum
+    first_codes = joint.codes[stratum_starts, :num_strata_cols]
+    strata_labels = [tuple(joint.categories[position][first_codes[s, position]] for position in range(num_strata_cols)) for s in range(len(stratum_starts))]
+    strata_labels = [label[0] if num_strata_cols == 1 else label for label in strata_labels]
+    if isinstance(n_samples, dict):
+        stratum_sizes = np.array([n_samples.get(label, 0) for label in strata_labels], dtype=np.int64)
+    else:
+        stratum_sizes = np.full(len(stratum_starts), n_samples, dtype=np.int64)
+    # Each stratum draws its uniforms from its own child stream, so its agents do not depend on which other strata are in the run
+    root_seed = as_seed_sequence(seed)
+    stratum_offsets = np.r_[0, np.cumsum(stratum_sizes)]
+    uniforms = np.empty(stratum_offsets[-1], dtype=np.float64)
+    for s, label in enumerate(strata_labels):
+        uniforms[stratum_offsets[s]:stratum_offsets[s + 1]] = np.random.default_rng(child_seed_sequence(root_seed, 'stratum', label)).random(stratum_sizes[s])
+    # Draw all strata at once: agent k of stratum s gets threshold s + u, which can only land inside stratum s
+    agent_strata = np.repeat(np.arange(len(stratum_starts)), stratum_sizes)
+    indices = np.searchsorted(global_cumulative, agent_strata + uniforms, side='right')
+    indices = np.clip(indices, stratum_starts[agent_strata], stratum_ends[agent_strata] - 1)
+    sampled_codes = joint.codes[indices]
+    sampled_columns = {}
+    for position in range(len(joint.column_names)):
+        if as_category:
+            sampled_columns[position] = pd.Categorical.from_codes(sampled_codes[:, position], categories=joint.categories[position])
+        else:
+            sampled_columns[position] = np.asarray(joint.categories[position], dtype=object)[sampled_codes[:, position]]
+    sample_df = pd.DataFrame(sampled_columns)
+    sample_df.columns = joint.column_names
     return sample_df
 
-# Function to iteratively generate sample populations of 100 agents for each country
+# Function to generate sample populations of n_samples agents for each country
 # E.g., grouping by the column "ISO 3166-1 numeric country code"
-def generate_country_sample_populations(df, country_col, columns_of_interest, n_samples):
+def generate_country_sample_populations(df, country_col, columns_of_interest, n_samples, seed=None):
+    # All countries are sampled in one pass (see generate_stratified_sample_populations), then split back into one DataFrame per country
+    combined_df = generate_stratified_sample_populations(df, country_col, columns_of_interest, n_samples, seed=seed)
     sample_populations = {}
-    # Get unique country codes
-    unique_countries = df[country_col].unique()
-    for country in unique_countries:
-        # Filter dataframe for the specific country
-        country_df = df[df[country_col] == country]
-        # Generate the joint probability matrix for the country
-        joint_prob_matrix = create_joint_probability_matrix(country_df, columns_of_interest)
-        # Generate the sample population for the country
-        sample_population = generate_sample_population(joint_prob_matrix, n_samples)
-        # Store the sample population in the dictionary
-        sample_populations[country] = sample_population
+    for country, country_df in combined_df.groupby(country_col, sort=False):
+        sample_populations[country] = country_df.drop(columns=country_col).reset_index(drop=True)
     return sample_populations
 
 # Function to convert the sample populations dictionary back into a dataframe
 def convert_sample_populations_to_df(sample_populations):
-    combined_df = pd.DataFrame()
+    sample_dfs = []
     for country_code, sample_df in sample_populations.items():
         sample_df = sample_df.reset_index()  # Reset index to convert multi-index to columns
         sample_df['Country_Code'] = country_code  # Add a new column for the country code
-        combined_df = pd.concat([combined_df, sample_df], ignore_index=True)
-    return combined_df
+        sample_dfs.append(sample_df)
+    # Concatenate once at the end (concatenating inside the loop copies the growing frame every time)
+    if not sample_dfs:
+        return pd.DataFrame()
+    return pd.concat(sample_dfs, ignore_index=True)
 
 def optimize_dataframe(df):
     for col in df.columns:
@@ -357,21 +1058,7 @@ def optimize_dataframe(df):
             df[col] = pd.to_numeric(df[col], downcast='float')
     return df
 
-# Applying the function to agents_df
-optimized_agents_df = optimize_dataframe(agents_df)
-
-# Define the existing agent dataset and the columns you are interested in
-#original_data_path = '/Users/stevenbickley/stevejbickley/data_assorted/Integrated_values_surveys_1981-2021_decoded_dta2xlsx_python.csv'
-original_data_path = '/Users/stevenbickley/stevejbickley/data_assorted/WVS_TimeSeries_1981_2022_Stata_v3_0.csv'
-column_mappings_path = '/Users/stevenbickley/stevejbickley/data_assorted/F00003843_WVS_EVS_Integrated_Dictionary_Codebook_v_2014_09_22.csv'
-
-# /Users/stevenbickley/stevejbickley/data_assorted/Integrated_values_surveys_1981-2021_decoded_stata.csv
-# /Users/stevenbickley/stevejbickley/data_assorted/Integrated_values_surveys_1981-2021_decoded_dta2xlsx_python.csv
-# /Users/stevenbickley/stevejbickley/data_assorted/SurveyLM_Agent_Profile_Generator/CustomisedProfile_WVS_v2.xlsx
-# '/Users/stevenbickley/stevejbickley/data_assorted/WVS_TimeSeries_1981_2022_Stata_v3_0.csv'
-
-## QUICK NEW FUNCTIONS
-
+# Function to subset the dataframe (e.g. the renamed WVS panel dataset) to specific columns and filters
 def subset_dataframe(df, columns_of_interest, control_columns, filter_dict=None, n=100, random=False, start=True):
     """
     Outputs a subset of the dataframe with specific columns and filters.
@@ -403,16 +1090,331 @@ def subset_dataframe(df, columns_of_interest, control_columns, filter_dict=None,
     return df_subset
 
 
-# Now read in the xlsx or csv file:
-# Note 1: agents_df.columns # View column names
-# Note 2: agents_df.columns.tolist() # View column names for datasets with > 30 columns
-try:
-    agents_df = pd.read_excel(original_data_path)
-except:
-    agents_df = pd.read_csv(original_data_path)
+# Function to convert a loaded column to a memory-efficient dtype (i.e. optimize_dataframe for a single column, where text is always categorical)
+def compact_column(values):
+    if pd.api.types.is_object_dtype(values.dtype) or pd.api.types.is_string_dtype(values.dtype):
+        return values.astype('category')
+    elif pd.api.types.is_integer_dtype(values.dtype):
+        return pd.to_numeric(values, downcast='integer')
+    elif pd.api.types.is_float_dtype(values.dtype):
+        return pd.to_numeric(values, downcast='float')
+    return values
+
+# Function to build the row filter of a filter_dict (a list, tuple or set value keeps any of its values, as with isin)
+def filter_dict_mask(df, filter_dict):
+    mask = np.ones(len(df), dtype=bool)
+    for col, val in filter_dict.items():
+        mask &= (df[col].isin(val) if isinstance(val, (list, tuple, set)) else df[col] == val).to_numpy()
+    return mask
+
+# Function to load only the needed columns (and rows, see filter_dict) of a panel dataset (e.g. the WVS/EVS integrated file), assigning compact dtypes while reading
+def load_panel_columns(data_path, columns_of_interest, control_columns=None, filter_dict=None, column_mapping=None, chunksize=200000):
+    filter_dict = filter_dict or {}
+    all_columns = list(dict.fromkeys(columns_of_interest + (control_columns or [])))
+    needed_columns = list(dict.fromkeys(all_columns + list(filter_dict)))
+    # Map the (label) column names back to the file's own column names
+    label_to_variable = {label: variable for variable, label in (column_mapping or {}).items()}
+    file_format = os.path.splitext(data_path)[1].lower()
+    if file_format == '.csv':
+        file_columns = pd.read_csv(data_path, nrows=0).columns
+    elif file_format == '.parquet':
+        import pyarrow.parquet as pq
+        file_columns = pq.ParquetFile(data_path).schema_arrow.names
+    else:
+        file_columns = pd.read_excel(data_path, nrows=0).columns
+    usecols = {}
+    for col in needed_columns:
+        if col in file_columns:
+            usecols[col] = col
+        elif label_to_variable.get(col) in file_columns:
+            usecols[label_to_variable[col]] = col
+        else:
+            raise KeyError(f"Column not found in {data_path}: {col}")
+    if file_format == '.parquet':
+        # Push the filters down to the parquet reader, so that non-matching row groups are skipped
+        filters = []
+        for variable, col in usecols.items():
+            if col in filter_dict:
+                val = filter_dict[col]
+                filters.append((variable, 'in', list(val)) if isinstance(val, (list, tuple, set)) else (variable, '==', val))
+        df = pd.read_parquet(data_path, columns=list(usecols), filters=filters or None).rename(columns=usecols)
+        return pd.DataFrame({col: compact_column(df[col]) for col in all_columns})
+    if file_format != '.csv':
+        df = pd.read_excel(data_path, usecols=list(usecols)).rename(columns=usecols)
+        df = df[filter_dict_mask(df, filter_dict)] if filter_dict else df
+        return pd.DataFrame({col: compact_column(df[col]) for col in all_columns}).reset_index(drop=True)
+    # Read the csv chunk by chunk, keeping only the matching rows of each chunk (as compact columns)
+    column_pieces = {col: [] for col in all_columns}
+    for chunk in pd.read_csv(data_path, usecols=list(usecols), chunksize=chunksize, low_memory=False):
+        chunk = chunk.rename(columns=usecols)
+        if filter_dict:
+            chunk = chunk[filter_dict_mask(chunk, filter_dict)]
+        for col in all_columns:
+            column_pieces[col].append(compact_column(chunk[col]))
+    loaded_columns = {}
+    for col, pieces in column_pieces.items():
+        if pieces and all(isinstance(piece.dtype, pd.CategoricalDtype) for piece in pieces):
+            # Each chunk has its own categories, so merge them rather than concatenating (which would fall back to object)
+            loaded_columns[col] = pd.Series(union_categoricals(pieces, ignore_order=True))
+        elif pieces and any(isinstance(piece.dtype, pd.CategoricalDtype) for piece in pieces):
+            # Text in some chunks and numbers in others, i.e. a mixed column
+            loaded_columns[col] = pd.concat([piece.astype(object) for piece in pieces], ignore_index=True).astype('category')
+        else:
+            loaded_columns[col] = pd.concat(pieces, ignore_index=True) if pieces else pd.Series(dtype=object)
+    return pd.DataFrame(loaded_columns)
+
+# Function to compute the sha256 of a (possibly multi-GB) file, reusing the hash stored in a sidecar file while the file's size and modification time are unchanged
+def file_content_hash(file_path, sidecar_path=None, block_size=8 * 1024 * 1024):
+    file_stat = os.stat(file_path)
+    if sidecar_path is not None and os.path.exists(sidecar_path):
+        with open(sidecar_path, 'r', encoding='utf-8') as f:
+            sidecar = json.load(f)
+        if sidecar.get('size') == file_stat.st_size and sidecar.get('mtime_ns') == file_stat.st_mtime_ns:
+            return sidecar['sha256']
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    if sidecar_path is not None:
+        with open(sidecar_path, 'w', encoding='utf-8') as f:
+            json.dump({'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns, 'sha256': file_hash.hexdigest()}, f)
+    return file_hash.hexdigest()
+
+# Function to compute a short digest of the rename/country mappings, so that editing a mapping invalidates the cached dataset
+def mapping_digest(*mappings):
+    mapping_items = [sorted(((str(k), str(v)) for k, v in mapping.items())) for mapping in mappings]
+    return hashlib.sha256(json.dumps([WVS_CACHE_VERSION, mapping_items]).encode('utf-8')).hexdigest()
+
+# Function to rename the WVS panel dataset columns (variable names to labels) and add the 'country_name' column
+def rename_wvs_columns(agents_df, column_mapping):
+    original_columns = list(agents_df.columns)
+    # Rename columns using the mappings
+    agents_df = agents_df.rename(columns=wvs_column_mapping)
+    agents_df = agents_df.rename(columns=column_mapping)
+    # Several variables can share a label, so keep the renamed columns unique by adding the variable name to any repeats
+    renamed_columns, seen_columns = [], set()
+    for original_col, col in zip(original_columns, agents_df.columns):
+        renamed_columns.append(col if col not in seen_columns else f"{col} ({original_col})")
+        seen_columns.add(renamed_columns[-1])
+    agents_df.columns = renamed_columns
+    # Resolve both country code columns (codes or names, see resolve_country_columns) in one vectorized pass
+    iso_codes, cow_codes, country_names = resolve_country_columns(agents_df['ISO 3166-1 numeric country code'], agents_df['CoW country code numeric'])
+    agents_df['ISO 3166-1 numeric country code'] = iso_codes
+    agents_df['CoW country code numeric'] = cow_codes
+    # Create the 'country_name' column by combining the mappings
+    agents_df['country_name'] = country_names
+    return agents_df
+
+# Function to normalise a raw country code or country name into a lookup key (e.g. 36, 36.0, '36' and ' 36 ' all become '36', and names are case-insensitive)
+def country_lookup_key(value):
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    text = str(value).strip()
+    try:
+        number = float(text)
+        if number.is_integer():
+            return str(int(number))
+    except ValueError:
+        pass
+    return text.lower()
+
+# Function to build (once per code system, then cached) the categorical lookup table of the ISO ('iso') or CoW ('cow') country mapping
+# Note: call country_lookup_table.cache_clear() after editing iso31661_code_to_country or cow_code_to_country at runtime
+@functools.lru_cache(maxsize=None)
+def country_lookup_table(code_system):
+    code_to_country = {'iso': iso31661_code_to_country, 'cow': cow_code_to_country}[code_system]
+    country_names = pd.Index(pd.unique(np.array(list(code_to_country.values()), dtype=object)))
+    key_to_code, key_to_position = {}, {}
+    for code, name in code_to_country.items():
+        # Both the code and the name resolve to the same entry (the first code wins if several codes share a name)
+        for key in (country_lookup_key(code), country_lookup_key(name)):
+            key_to_code.setdefault(key, code)
+            key_to_position.setdefault(key, country_names.get_loc(name))
+    # Entries for the missing-value codes (i.e. 'a'..'e' and -1), which are not countries
+    missing_positions = {country_names.get_loc(name) for code, name in code_to_country.items() if isinstance(code, str) or code < 0}
+    return country_names, key_to_code, key_to_position, frozenset(missing_positions)
+
+# Function to resolve a column of country codes or country names (of one code system), looking up each distinct value once
+# --> Returns (numeric codes, -1 for missing-value codes and unresolved values; positions into the country names; the country names)
+def resolve_country_codes(values, code_system='iso'):
+    country_names, key_to_code, key_to_position, _ = country_lookup_table(code_system)
+    value_codes, unique_values = pd.factorize(pd.Series(values), use_na_sentinel=True)
+    unique_numeric_codes, unique_positions = [], []
+    for value in unique_values:
+        key = country_lookup_key(value)
+        code = key_to_code.get(key, -1)
+        unique_numeric_codes.append(code if not isinstance(code, str) else -1)
+        unique_positions.append(key_to_position.get(key, -1))
+    # Missing values (NaN) have code -1, i.e. the trailing entry, which resolves like the -1 code itself
+    unique_numeric_codes.append(-1)
+    unique_positions.append(key_to_position.get('-1', -1))
+    numeric_codes = np.array(unique_numeric_codes, dtype=np.int64)[value_codes]
+    positions = np.array(unique_positions, dtype=np.int64)[value_codes]
+    return numeric_codes, positions, country_names
+
+# Function to resolve the ISO and CoW country columns together, i.e. their numeric codes and one combined 'country_name' (categorical)
+# Note: a real country in either column wins over a missing-value code in the other (ISO first), and values that resolve in neither column become "Undefined"
+def resolve_country_columns(iso_values, cow_values):
+    iso_codes, iso_positions, iso_names = resolve_country_codes(iso_values, 'iso')
+    cow_codes, cow_positions, cow_names = resolve_country_codes(cow_values, 'cow')
+    combined_names = pd.Index(pd.unique(np.array(list(iso_names) + list(cow_names) + ["Undefined"], dtype=object)))
+    # Map each code system's positions into the combined categories (the trailing entry is for unresolved values, i.e. position -1)
+    iso_to_combined = np.append(combined_names.get_indexer(iso_names), -1)
+    cow_to_combined = np.append(combined_names.get_indexer(cow_names), -1)
+    iso_missing = np.append(np.isin(np.arange(len(iso_names)), list(country_lookup_table('iso')[3])), True)
+    cow_missing = np.append(np.isin(np.arange(len(cow_names)), list(country_lookup_table('cow')[3])), True)
+    combined_positions = np.where(~iso_missing[iso_positions], iso_to_combined[iso_positions],
+                         np.where(~cow_missing[cow_positions], cow_to_combined[cow_positions],
+                         np.where(iso_positions >= 0, iso_to_combined[iso_positions],
+                         np.where(cow_positions >= 0, cow_to_combined[cow_positions], combined_names.get_loc("Undefined")))))
+    country_names = pd.Categorical.from_codes(combined_positions, categories=combined_names)
+    return iso_codes, cow_codes, country_names
+
+# Function to build (once) a Parquet cache of the renamed WVS panel dataset, keyed on the source file's content hash and the mappings used (returns its path)
+def build_wvs_panel_cache(original_data_path, column_mappings_path, cache_dir=None):
+    try:
+        import pyarrow  # noqa: F401 (only needed by pandas' parquet reader/writer)
+    except ImportError:
+        raise ImportError("The WVS panel cache requires pyarrow (e.g. 'poetry add pyarrow').")
+    cache_dir = cache_dir if cache_dir is not None else os.path.dirname(os.path.abspath(original_data_path))
+    os.makedirs(cache_dir, exist_ok=True)
+    fname = extract_filename(original_data_path)
+    source_hash = file_content_hash(original_data_path, sidecar_path=os.path.join(cache_dir, fname + '_source_hash.json'))
+    # Read in the Codebook Mapping from question names to labels, i.e. a dictionary from the "VARIABLE" and "LABEL" columns
+    column_mapping = pd.read_csv(column_mappings_path, encoding='latin1').set_index('VARIABLE')['LABEL'].to_dict()
+    digest = mapping_digest(wvs_column_mapping, column_mapping, iso31661_code_to_country, cow_code_to_country)
+    cache_path = os.path.join(cache_dir, f"{fname}_columns_renamed_{source_hash[:12]}_{digest[:12]}.parquet")
+    if os.path.exists(cache_path):
+        return cache_path
+    agents_df = pd.read_csv(original_data_path, low_memory=False) if original_data_path.endswith('.csv') else pd.read_excel(original_data_path)
+    agents_df = rename_wvs_columns(agents_df, column_mapping)
+    # Store repetitive text columns as categoricals (and downcast numbers) to reduce the size of the cache and of every later load
+    agents_df = optimize_dataframe(agents_df)
+    agents_df.columns = [str(col) for col in agents_df.columns]
+    temp_path = cache_path + '.tmp' # Written under a temporary name first, so an interrupted run never leaves a partial cache behind
+    agents_df.to_parquet(temp_path, index=False)
+    os.replace(temp_path, cache_path)
+    return cache_path
+
+# Function to load (only) the needed columns of the renamed WVS panel dataset, building its Parquet cache first if needed
+def load_wvs_panel(original_data_path, column_mappings_path, columns=None, cache_dir=None):
+    cache_path = build_wvs_panel_cache(original_data_path, column_mappings_path, cache_dir=cache_dir)
+    return pd.read_parquet(cache_path, columns=columns)
+
+# Compare the distributions
+def compare_distributions(original_data_path, column_names, sample_population):
+    original_joint_prob_matrix = create_joint_probability_matrix(original_data_path, column_names)
+    sample_joint_prob_matrix = create_joint_probability_matrix(sample_population, column_names)
+    print("Original Joint Probability Matrix:")
+    print(original_joint_prob_matrix)
+    print("\nSample Joint Probability Matrix:")
+    print(sample_joint_prob_matrix)
+    # Add further comparison logic or statistical analysis here
+
+# Kolmogorov-Smirnov Test (KS Test)
+# --> Good for numerical data (preferred continuous but can do discrete)
+def ks_test(original_data, synthetic_data, column_name):
+    ks_statistic, p_value = ks_2samp(original_data[column_name], synthetic_data[column_name])
+    return ks_statistic, p_value
+
+# Function to perform pairwise chi-squared tests for a set of variables, using Bonferroni correction to adjust the p-values
+# --> Good for string or categorical distributions
+def perform_pairwise_chi_squared_tests(original_data, new_data, column_names):
+    results = {}
+    # For Bonferroni correction, count all pairwise comparisons
+    num_comparisons = len(column_names)
+    alpha = 0.05 / num_comparisons  # Adjust alpha for multiple testing
+    for column_name in column_names:
+        # Create contingency table for each column
+        original_freq = original_data[column_name].value_counts()
+        new_freq = new_data[column_name].value_counts()
+        # Make sure both Series have the same index for accurate comparison
+        combined_index = original_freq.index.union(new_freq.index)
+        original_freq = original_freq.reindex(combined_index, fill_value=0)
+        new_freq = new_freq.reindex(combined_index, fill_value=0)
+        contingency_table = pd.DataFrame({
+            'original': original_freq,
+            'new': new_freq
+        })
+        # Compute the chi-squared test
+        chi2, p_value, _, _ = chi2_contingency(contingency_table)
+        # Store results
+        results[column_name] = {'chi2': chi2, 'p_value': p_value, 'significant': p_value < alpha}
+    return results
 
-# Create column mapping dictionary
-column_mapping = {
+# Function to code the original and synthetic values of each column with shared integer codes (sorted categories, missing values get -1)
+def shared_integer_codes(original_data, synthetic_data, column_names):
+    coded_columns = {}
+    for col in column_names:
+        combined_values = pd.concat([original_data[col], synthetic_data[col]], ignore_index=True)
+        try:
+            codes, uniques = pd.factorize(combined_values, sort=True)
+        except TypeError: # Mixed types (e.g. numbers and text) cannot be sorted
+            codes, uniques = pd.factorize(combined_values.astype(str).where(combined_values.notna()), sort=True)
+        coded_columns[col] = (codes[:len(original_data)], codes[len(original_data):], len(uniques))
+    return coded_columns
+
+# Function to compare two frequency vectors (original vs synthetic) of the same cells, i.e. total-variation distance plus a chi-squared test of homogeneity
+# Note: the chi-squared test is uncorrected, i.e. unlike chi2_contingency (used by perform_pairwise_chi_squared_tests) there is no Yates' continuity
+# correction when the table has one degree of freedom (e.g. binary columns), so its p-values are slightly smaller there
+def compare_frequencies(original_counts, synthetic_counts):
+    original_total, synthetic_total = original_counts.sum(), synthetic_counts.sum()
+    if original_total == 0 or synthetic_total == 0:
+        raise ValueError("Cannot compare frequencies when the original or the synthetic sample is empty (no non-missing values).")
+    tvd = 0.5 * np.abs(original_counts / original_total - synthetic_counts / synthetic_total).sum()
+    # Chi-squared test of the 2 x (observed cells) contingency table (cells that are empty in both samples are dropped)
+    observed_cells = (original_counts + synthetic_counts) > 0
+    observed = np.vstack([original_counts[observed_cells], synthetic_counts[observed_cells]]).astype(np.float64)
+    expected = observed.sum(axis=1, keepdims=True) * observed.sum(axis=0, keepdims=True) / observed.sum()
+    chi2_statistic = ((observed - expected) ** 2 / expected).sum()
+    chi2_dof = observed.shape[1] - 1
+    chi2_p_value = chi2.sf(chi2_statistic, chi2_dof) if chi2_dof > 0 else 1.0
+    return tvd, chi2_statistic, chi2_dof, chi2_p_value
+
+# Function to report how closely a synthetic population reproduces the original one, for every column and every pair of columns (Bonferroni-corrected per level)
+# Note: the KS test (marginals only, on the sorted category codes) is only meaningful for ordered columns, and its p-value is the asymptotic one
+def distribution_fidelity_report(original_data, synthetic_data, column_names, pairwise=True, alpha=0.05):
+    if original_data.empty or synthetic_data.empty:
+        raise ValueError("Cannot report the fidelity of an empty original or synthetic population.")
+    coded_columns = shared_integer_codes(original_data, synthetic_data, column_names)
+    results = []
+    for col in column_names:
+        original_codes, synthetic_codes, num_categories = coded_columns[col]
+        original_counts = np.bincount(original_codes[original_codes >= 0], minlength=num_categories)
+        synthetic_counts = np.bincount(synthetic_codes[synthetic_codes >= 0], minlength=num_categories)
+        tvd, chi2_statistic, chi2_dof, chi2_p_value = compare_frequencies(original_counts, synthetic_counts)
+        # Two-sample KS test on the codes, computed from the two cumulative distributions (asymptotic p-value, as ks_2samp(method='asymp'))
+        n, m = original_counts.sum(), synthetic_counts.sum()
+        ks_statistic = np.abs(np.cumsum(original_counts) / n - np.cumsum(synthetic_counts) / m).max()
+        ks_p_value = kstwo.sf(ks_statistic, int(round(n * m / (n + m))))
+        results.append({'level': 'marginal', 'column_1': col, 'column_2': None, 'tvd': tvd, 'chi2': chi2_statistic, 'chi2_dof': chi2_dof,
+                        'chi2_p_value': chi2_p_value, 'ks_statistic': ks_statistic, 'ks_p_value': ks_p_value})
+    if pairwise:
+        for col_1, col_2 in itertools.combinations(column_names, 2):
+            original_1, synthetic_1, num_categories_1 = coded_columns[col_1]
+            original_2, synthetic_2, num_categories_2 = coded_columns[col_2]
+            # Each pair of codes becomes one cell code, so each joint distribution is a single bincount
+            original_valid = (original_1 >= 0) & (original_2 >= 0)
+            synthetic_valid = (synthetic_1 >= 0) & (synthetic_2 >= 0)
+            num_cells = num_categories_1 * num_categories_2
+            original_counts = np.bincount(original_1[original_valid] * num_categories_2 + original_2[original_valid], minlength=num_cells)
+            synthetic_counts = np.bincount(synthetic_1[synthetic_valid] * num_categories_2 + synthetic_2[synthetic_valid], minlength=num_cells)
+            tvd, chi2_statistic, chi2_dof, chi2_p_value = compare_frequencies(original_counts, synthetic_counts)
+            results.append({'level': 'pairwise', 'column_1': col_1, 'column_2': col_2, 'tvd': tvd, 'chi2': chi2_statistic, 'chi2_dof': chi2_dof,
+                            'chi2_p_value': chi2_p_value, 'ks_statistic': np.nan, 'ks_p_value': np.nan})
+    report = pd.DataFrame(results)
+    # Bonferroni correction, i.e. divide alpha by the number of tests at each level
+    num_tests = report.groupby('level')['level'].transform('size')
+    report['significant'] = report['chi2_p_value'] < alpha / num_tests
+    return report
+
+##### ------ DEFINE MAPPINGS - START ------- ####
+
+# Version of the renamed WVS panel dataset cache (see build_wvs_panel_cache), increase this when rename_wvs_columns changes
+WVS_CACHE_VERSION = 2
+
+# Create column mapping dictionary (WVS variable names to labels)
+wvs_column_mapping = {
     "version": "Version of Data File",
     "doi": "Digital Object Identifier",
     "S002VS": "Chronology of EVS-WVS waves",
@@ -948,18 +1950,6 @@ column_mapping = {
     "I002B": "It is not important for me to know about science in my daily life"
 }
 
-# Rename columns using the mapping
-agents_df = agents_df.rename(columns=column_mapping)
-
-# Read in the Codebook Mapping from question names to labels
-column_mapping_df = pd.read_csv(column_mappings_path, encoding='latin1')
-
-# Create a dictionary from the "VARIABLE" and "LABEL" columns
-column_mapping = column_mapping_df.set_index('VARIABLE')['LABEL'].to_dict()
-
-# Rename columns using the mapping
-agents_df = agents_df.rename(columns=column_mapping)
-
 # Create the code-to-country name mapping dictionary
 iso31661_code_to_country = {
     8: 'Albania', 12: 'Algeria', 20: 'Andorra', 31: 'Azerbaijan', 32: 'Argentina', 36: 'Australia', 40: 'Austria',
@@ -1019,178 +2009,162 @@ cow_code_to_country = {
 # Invert the dictionary to map country names back to their numeric codes (OPTIONAL)
 cow_country_to_code = {v: k for k, v in cow_code_to_country.items()}
 
-# If numeric code is actually already country name then convert back to code then proceed..
-agents_df['ISO 3166-1 numeric country code'] = agents_df['ISO 3166-1 numeric country code'].map(iso31661_country_to_code)
-agents_df['CoW country code numeric'] = agents_df['CoW country code numeric'].map(cow_country_to_code)
-
-# Convert the columns of interest to integer type
-agents_df['ISO 3166-1 numeric country code'] = agents_df['ISO 3166-1 numeric country code'].fillna(-1) # But first... fill non-finite values with a placeholder (e.g., -1)
-agents_df['CoW country code numeric'] = agents_df['CoW country code numeric'].fillna(-1)
-agents_df['ISO 3166-1 numeric country code'] = agents_df['ISO 3166-1 numeric country code'].astype(int)
-agents_df['CoW country code numeric'] = agents_df['CoW country code numeric'].astype(int)
-
-# Create the 'country_name' column by combining the mappings
-agents_df['country_name'] = agents_df['ISO 3166-1 numeric country code'].map(iso31661_code_to_country).combine_first(agents_df['CoW country code numeric'].map(cow_code_to_country)).fillna("Undefined")
-
-# Applying "optimise_dataframe"  to agents_df to reduce memory usage of the dataset before writing to file/analysis
-#agents_df = optimize_dataframe(agents_df)
-
-# Save the result to csv file (OPTIONAL)
-agents_df.to_csv("/Users/stevenbickley/stevejbickley/data_assorted/" + str(extract_filename(original_data_path)) + "_columns_renamed.csv",index=False,encoding='utf-8')
-
-# Now read in the xlsx or csv file:
-# Note 1: agents_df.columns # View column names
-# Note 2: agents_df.columns.tolist() # View column names for datasets with > 30 columns
-try:
-    agents_df = pd.read_excel("/Users/stevenbickley/stevejbickley/data_assorted/" + str(extract_filename(original_data_path)) + "_columns_renamed.xlsx")
-except:
-    agents_df = pd.read_csv("/Users/stevenbickley/stevejbickley/data_assorted/" + str(extract_filename(original_data_path)) + "_columns_renamed.csv")
-
-# Display the first 5 rows of agents_df
-#pd.set_option('display.max_columns', None)
-#pd.set_option('display.width', 1000)
-#agents_df.head()
-#agents_df[agents_df['country_name']=='Australia']['Year survey'].unique() # array([1981, 1995, 2005, 2012, 2018])
-
-# Example usage
-#columns_of_interest = ['Sex', 'Age', 'Ethnic group', 'Highest educational level attained', 'Marital status', 'Employment status', 'Profession/job','Social class (subjective)','Scale of incomes','Self positioning in political scale','Religious denominations - major groups']
-#control_columns = ['Mode of data collection', 'Date interview', 'Year survey', 'country_name', 'Employment status - Respondent’s Spouse','Highest educational level attained - Respondent’s Father ISCED','Highest educational level attained - Respondent’s Mother ISCED','Respondent’s Father - Occupational group (when respondent was 14 years old)', "Respondent interested during interview", "Interview privacy", "Language in which interview was conducted"]
-#filter_dict = {'country_name': 'Australia', 'Year survey': 2018} # Apply filtering - 'Year survey': 2018, 'Mode of data collection': 'Face to face',
-#df_subset = subset_dataframe(agents_df, columns_of_interest, control_columns, filter_dict, n=100, random=False, start=True) # Subset the dataframe
-
-# Select the columns of interest - for example, see e.g., Hughes, Camden, Yangchen & College (2016) and Fassett, Wolcott, Harpe, McLaughlin (2022):
-# The "Core Set": Age, Gender Identity, Biological Sex, Ethnicity/Race, Education, Location/Geographic Data
-# The "Wider Set": Political Preferences, Family and Dependents, Language Spoken, Religion and Spiritual Beliefs/Group Membership(s), Sexual Orientation, Disability Status, Employment Status, Industry/Type of Employment, Social/Socioeconomic Class (Current), Marital/Relationship Status, Household Income
-# The "Extended Set": Parent/Guardian's Highest Level of Education, Parent/Guardian's Industry/Type of Employment, Respondent's Household Wealth/Socio-Economic Status Growing Up
-
-# 1) Core Set
-#columns_of_interest = ['Sex','Age','Ethnic group','Highest educational level attained','country_name']
-columns_of_interest = ['Sex', 'Age', 'Ethnic group', 'Highest educational level attained', 'Marital status', 'Employment status'] # Core Set for MGuihot AIGHP and ART..
-
-
-# 2) Wider Set
-#columns_of_interest = ['Sex','Age','Ethnic group','Highest educational level attained','country_name', 'Marital status', 'Employment status', 'How many children do you have','Employment status','Profession/job','Social class (subjective)','Scale of incomes','Self positioning in political scale','Religious denominations - major groups'] # Wider Set
-# We are missing 'Disability Status/Diagnosis' and 'Sexual Identity/Orientation' from the World Values Survey (i.e. they do not collect this) but thankfully.. we can add this via the SurveyLM platform - e.g.g 'Disability Status/Diagnosis' we could do: 'Physical Disability', 'Mental Disability', 'Neurodivergent', 'Both mental and physical disability', 'No mental or physical disability', 'Prefer not to answer'
-# From Hughes, Camden, Yangchen & College (2016) for the 'Disability Status/Diagnosis' variable/column: 'No diagnosed disability or impairment','A  sensory impairment (vision or hearing)', 'A mobility impairment','A learning disability (e.g., ADHD, dyslexia)', 'A mental health disorder','A disability or impairment not listed above'
-# OR... From Fassett, Wolcott, Harpe, McLaughlin (2022) for the 'Disability Status/Diagnosis' variable/column: 'Blind or low vision', 'Deaf or hard of hearing', 'Mobility condition that affects walking', 'Mobility condition that does not affect walking', 'Speech or communication disorder', 'Traumatic or acquired brain injury', 'Anxiety', 'Attention deficit or hyperactivity disorder (ADD or ADHD)', 'Autism spectrum', 'Depression', 'Another mental health or developmental disability (schizophrenia, eating disorder, etc.)', 'Chronic medical condition (asthma, diabetes, Crohn's disease, etc.)', 'Learning disability', 'Intellectual disability', 'Disability or condition not listed'
-# From Hughes, Camden, Yangchen & College (2016) for the 'Sexual Identity/Orientation' variable/column: 'Heterosexual or straight','Gay or lesbian','Bisexual','Fluid','Pansexual','Queer','Demisexual','Questioning','Asexual','I prefer not to answer.'
-
-# 3) Extended Set
-#columns_of_interest = ['Sex','Age','Ethnic group','Highest educational level attained','country_name','How many children do you have','Language of the interview','Employment status','Profession/job','Social class (subjective)','Marital status','Scale of incomes','Self positioning in political scale','Religious denominations - major groups','Employment status - Respondent’s Spouse','Highest educational level attained - Respondent’s Father ISCED','Highest educational level attained - Respondent’s Mother ISCED','Respondent’s Father - Occupational group (when respondent was 14 years old)']
-# From Hughes, Camden, Yangchen & College (2016) for the 'Socioeconomic class/situation during childhood' variable/column: 'Poor','Working Class','Middle Class','Affluent'
-# From Fassett, Wolcott, Harpe, McLaughlin (2022) for the 'Family status/situation growing up' variable/column: 'Raised by married parents', 'Raised by foster parents','Raised by single parent','Raised by divorced parents'
-# From Fassett, Wolcott, Harpe, McLaughlin (2022) for the 'Geographic region raised during childhood' variable/column: 'Rural','Suburb','Urban'
-
-## ---- From 'WVS_TimeSeries_1981_2022_Stata_v3_0_some_columns_renamed.csv':
+##### ------ MAIN CODE - START ------- ####
 
-# --> The "Core Set": ['Sex','Age','Ethnic group','Highest educational level attained','country_name']
-# Possible alternatives to 'Age' variable/column: 'Year of birth', 'Age recoded (6 intervals)', 'Age recoded (3 intervals)'
-# Possible alternatives to 'Highest educational level attained' variable/column: 'Highest educational level attained - Respondent ISCED-2011','Education level (recoded)','What age did you complete your education','What age did you complete your education (recoded in intervals)'
-# Possible alternatives to 'country_name' variable/column: 'ISO 3166-1 alpha-3 country code','CoW country code alpha','Region ISO 3166-2','Region where the interview was conducted (WVS)','Settlement size','Settlement type where interview was conducted','Urban/Rural habitat','Type of habitat'
+# Note: the main code only runs when this file is executed directly (i.e. not when it is imported or re-imported by worker processes)
+if __name__ == "__main__":
+    ## ------ SECTION 1: Generate synthetic data using manually-designed agent inputs file ------ ##
+    input_file_paths = glob.glob('sample_profiles_input_'+'*_v2.xlsx')
+
+    # Read the file into a DataFrame
+    #input_file_path = 'sample_profile_generation_input_v5.xlsx'
+    #input_file_path = 'Ana_Maria_Matrix_for_agent_generation_updated_SB_31May2024.xlsx' # NOTE: old input file type used (v3)
+    #input_file_path = 'sample_profiles_input_DOOTSON_STUDY_v2.xlsx'
+
+    # Example usage (one input file per worker process; set master_seed to an integer to reproduce a run)
+    num_agents = 500
+    generation_timings = run_profile_generation_parallel(input_file_paths, num_agents=num_agents, master_seed=None, max_workers=None)
+    #generation_timings.to_csv('sample_profiles_input_generation_timings.csv', index=False) # (OPTIONAL) Save the per-file timings
+
+    # (OLD) One input file at a time
+    #for input_file_path in input_file_paths:
+    #    result = generate_agents_for_input_file(input_file_path, num_agents=num_agents, seed=None)
+    #agents_df = pd.read_excel(input_file_path[:-5] + '_agents_output.xlsx') # (OPTIONAL) Load an output file back in
+    #agents_df.columns # (OPTIONAL) Check column names
+
+
+
+    ## ------ SECTION 2: Generate synthetic data using existing agent inputs file ------ ##
+
+    # Applying the function to agents_df (OPTIONAL)
+    #optimized_agents_df = optimize_dataframe(agents_df)
+
+    # Define the existing agent dataset and the columns you are interested in
+    #original_data_path = '/Users/stevenbickley/stevejbickley/data_assorted/Integrated_values_surveys_1981-2021_decoded_dta2xlsx_python.csv'
+    original_data_path = '/Users/stevenbickley/stevejbickley/data_assorted/WVS_TimeSeries_1981_2022_Stata_v3_0.csv'
+    column_mappings_path = '/Users/stevenbickley/stevejbickley/data_assorted/F00003843_WVS_EVS_Integrated_Dictionary_Codebook_v_2014_09_22.csv'
+
+    # /Users/stevenbickley/stevejbickley/data_assorted/Integrated_values_surveys_1981-2021_decoded_stata.csv
+    # /Users/stevenbickley/stevejbickley/data_assorted/Integrated_values_surveys_1981-2021_decoded_dta2xlsx_python.csv
+    # /Users/stevenbickley/stevejbickley/data_assorted/SurveyLM_Agent_Profile_Generator/CustomisedProfile_WVS_v2.xlsx
+    # '/Users/stevenbickley/stevejbickley/data_assorted/WVS_TimeSeries_1981_2022_Stata_v3_0.csv'
+
+    # Read in the renamed dataset from its Parquet cache (built on the first run from the csv, the codebook and the mappings, see build_wvs_panel_cache)
+    # Note 1: agents_df.columns # View column names
+    # Note 2: agents_df.columns.tolist() # View column names for datasets with > 30 columns
+    # Note 3: only the columns of interest and the country column are loaded (much faster and a fraction of the memory), so add e.g. control_columns
+    # to the list to use subset_dataframe below, or pass columns=None to load every column
+    # Select the columns of interest (see the "Core Set", "Wider Set" and "Extended Set" options below) and the country column to stratify by
+    columns_of_interest = ['Sex', 'Age', 'Ethnic group', 'Highest educational level attained', 'Marital status', 'Employment status'] # Core Set for MGuihot AIGHP and ART..
+    country_col = 'country_name' # 'ISO 3166-1 numeric country code'
+    agents_df = load_wvs_panel(original_data_path, column_mappings_path, columns=columns_of_interest + [country_col])
+
+    # Save the result to csv file (OPTIONAL)
+    #agents_df.to_csv("/Users/stevenbickley/stevejbickley/data_assorted/" + str(extract_filename(original_data_path)) + "_columns_renamed.csv",index=False,encoding='utf-8')
 
-# --> The "Wider Set": ['How many children do you have','Language of the interview','Employment status','Profession/job','Social class (subjective)','Marital status','Scale of incomes','Self positioning in political scale','Religious denominations - major groups']
-# Note: we are missing/yet to add... --> sexual orientation, disability
-# Possible alternatives to 'How many children do you have' variable/column: 'Have you had any children', 'How many are still living at home', 'Number of people in household'
-# Possible alternatives to 'Language of the interview' variable/column: 'Language in which interview was conducted'
-# Possible alternatives to 'Profession/job' variable/column: 'Respondent - Occupational group (WVS)', 'Chief wage earner profession/job'
-# Possible alternatives to 'Social class (subjective)' variable/column: 'Social class (subjective) with 6 categories','Family savings during past year'
-# Possible alternatives to 'Marital status' variable/column: 'Have you been married before'
-# Possible alternatives to 'Scale of incomes' variable/column: 'Scale of incomes (Country specific)','Subjective income level (recoded in 3 groups)'
-# Possible alternatives to 'Self positioning in political scale' variable/column: 'Political action: joining in boycotts','Political action recently done: joining in boycotts','Political action: attending lawful/peaceful demonstrations','Current society: Egalitarian vs. competitive society','Current society: Extensive welfare vs. low taxes','Current society: Regulated vs. responsible society','Society aimed: egalitarian vs. competitive','Society aimed: extensive welfare vs. low taxes'
-# Possible alternatives to 'Religious denominations - major groups' variable/column: 'Belong to religious denomination', 'F025_WVS', 'Which former religious denomination', 'How often do you attend religious services', 'How often do you pray', 'Raised religiously','Important in life: Religion','Personal God vs. Spirit or Life Force','How important is God in your life','Get comfort and strength from religion','Neighbours: People of a different religion','Neighbours: People of the same religion','Sharing with partner: attitudes towards religion','Sharing with parents: attitudes towards religion','Moments of prayer, meditation...','Pray to God outside of religious services (I)','Pray to God outside of religious services (ii)','Politicians who don't believe in God are unfit for public office',''
+    # Display the first 5 rows of agents_df
+    #pd.set_option('display.max_columns', None)
+    #pd.set_option('display.width', 1000)
+    #agents_df.head()
+    #agents_df[agents_df['country_name']=='Australia']['Year survey'].unique() # array([1981, 1995, 2005, 2012, 2018])
 
+    # Example usage
+    #columns_of_interest = ['Sex', 'Age', 'Ethnic group', 'Highest educational level attained', 'Marital status', 'Employment status', 'Profession/job','Social class (subjective)','Scale of incomes','Self positioning in political scale','Religious denominations - major groups']
+    #control_columns = ['Mode of data collection', 'Date interview', 'Year survey', 'country_name', 'Employment status - Respondent’s Spouse','Highest educational level attained - Respondent’s Father ISCED','Highest educational level attained - Respondent’s Mother ISCED','Respondent’s Father - Occupational group (when respondent was 14 years old)', "Respondent interested during interview", "Interview privacy", "Language in which interview was conducted"]
+    #filter_dict = {'country_name': 'Australia', 'Year survey': 2018} # Apply filtering - 'Year survey': 2018, 'Mode of data collection': 'Face to face',
+    #df_subset = subset_dataframe(agents_df, columns_of_interest, control_columns, filter_dict, n=100, random=False, start=True) # Subset the dataframe
+    #df_subset = load_panel_columns(build_wvs_panel_cache(original_data_path, column_mappings_path), columns_of_interest, control_columns, filter_dict) # Or... read only these columns and rows (filters pushed down to the reader)
 
+    # Select the columns of interest - for example, see e.g., Hughes, Camden, Yangchen & College (2016) and Fassett, Wolcott, Harpe, McLaughlin (2022):
+    # The "Core Set": Age, Gender Identity, Biological Sex, Ethnicity/Race, Education, Location/Geographic Data
+    # The "Wider Set": Political Preferences, Family and Dependents, Language Spoken, Religion and Spiritual Beliefs/Group Membership(s), Sexual Orientation, Disability Status, Employment Status, Industry/Type of Employment, Social/Socioeconomic Class (Current), Marital/Relationship Status, Household Income
+    # The "Extended Set": Parent/Guardian's Highest Level of Education, Parent/Guardian's Industry/Type of Employment, Respondent's Household Wealth/Socio-Economic Status Growing Up
 
-# --> The "Extended Set": ['Employment status - Respondent’s Spouse','Highest educational level attained - Respondent’s Father ISCED','Highest educational level attained - Respondent’s Mother ISCED','Respondent’s Father - Occupational group (when respondent was 14 years old)']
-# Note: we are missing/yet to add... --> Respondent's Wealth/Socio-Economic Status/Living Situation During Childhood
-# Possible alternatives to 'Highest educational level attained - Respondent’s Father ISCED' variable/column: 'Highest educational level attained - Respondent’s Father (Recoded)'
-# Possible alternatives to 'Highest educational level attained - Respondent’s Mother ISCED' variable/column: 'Highest educational level attained - Respondent’s Mother (Recoded)'
-# Possible alternatives to 'XXXX' variable/column: 'XXXX', 'XXXX', 'XXXX', 'XXXX'
+    # 1) Core Set
+    #columns_of_interest = ['Sex','Age','Ethnic group','Highest educational level attained','country_name']
+    #columns_of_interest = ['Sex', 'Age', 'Ethnic group', 'Highest educational level attained', 'Marital status', 'Employment status'] # Core Set for MGuihot AIGHP and ART.. (set above, before the panel is loaded)
 
-## ----
 
-# For the other synthetic/real-world datasets:
-# 'agents_output.xlsx' --> ['Age in years', 'Self-described gender', 'Highest level of education']
-# 'CustomisedProfile_WVS_v2.xlsx' --> ['Sex (1=Male, 2=Female)', 'Age', 'Marital status (1=Married, 6=Single)']
-# 'Integrated_values_surveys_1981-2021_decoded_dta2xlsx_python.csv' -->
+    # 2) Wider Set
+    #columns_of_interest = ['Sex','Age','Ethnic group','Highest educational level attained','country_name', 'Marital status', 'Employment status', 'How many children do you have','Employment status','Profession/job','Social class (subjective)','Scale of incomes','Self positioning in political scale','Religious denominations - major groups'] # Wider Set
+    # We are missing 'Disability Status/Diagnosis' and 'Sexual Identity/Orientation' from the World Values Survey (i.e. they do not collect this) but thankfully.. we can add this via the SurveyLM platform - e.g.g 'Disability Status/Diagnosis' we could do: 'Physical Disability', 'Mental Disability', 'Neurodivergent', 'Both mental and physical disability', 'No mental or physical disability', 'Prefer not to answer'
+    # From Hughes, Camden, Yangchen & College (2016) for the 'Disability Status/Diagnosis' variable/column: 'No diagnosed disability or impairment','A  sensory impairment (vision or hearing)', 'A mobility impairment','A learning disability (e.g., ADHD, dyslexia)', 'A mental health disorder','A disability or impairment not listed above'
+    # OR... From Fassett, Wolcott, Harpe, McLaughlin (2022) for the 'Disability Status/Diagnosis' variable/column: 'Blind or low vision', 'Deaf or hard of hearing', 'Mobility condition that affects walking', 'Mobility condition that does not affect walking', 'Speech or communication disorder', 'Traumatic or acquired brain injury', 'Anxiety', 'Attention deficit or hyperactivity disorder (ADD or ADHD)', 'Autism spectrum', 'Depression', 'Another mental health or developmental disability (schizophrenia, eating disorder, etc.)', 'Chronic medical condition (asthma, diabetes, Crohn's disease, etc.)', 'Learning disability', 'Intellectual disability', 'Disability or condition not listed'
+    # From Hughes, Camden, Yangchen & College (2016) for the 'Sexual Identity/Orientation' variable/column: 'Heterosexual or straight','Gay or lesbian','Bisexual','Fluid','Pansexual','Queer','Demisexual','Questioning','Asexual','I prefer not to answer.'
 
-# Generate the joint probability matrix
-joint_prob_matrix = create_joint_probability_matrix(agents_df, columns_of_interest)
-#joint_prob_matrix.index.nlevels
-#joint_prob_matrix.columns.nlevels
+    # 3) Extended Set
+    #columns_of_interest = ['Sex','Age','Ethnic group','Highest educational level attained','country_name','How many children do you have','Language of the interview','Employment status','Profession/job','Social class (subjective)','Marital status','Scale of incomes','Self positioning in political scale','Religious denominations - major groups','Employment status - Respondent’s Spouse','Highest educational level attained - Respondent’s Father ISCED','Highest educational level attained - Respondent’s Mother ISCED','Respondent’s Father - Occupational group (when respondent was 14 years old)']
+    # From Hughes, Camden, Yangchen & College (2016) for the 'Socioeconomic class/situation during childhood' variable/column: 'Poor','Working Class','Middle Class','Affluent'
+    # From Fassett, Wolcott, Harpe, McLaughlin (2022) for the 'Family status/situation growing up' variable/column: 'Raised by married parents', 'Raised by foster parents','Raised by single parent','Raised by divorced parents'
+    # From Fassett, Wolcott, Harpe, McLaughlin (2022) for the 'Geographic region raised during childhood' variable/column: 'Rural','Suburb','Urban'
 
-# Now, generate a sample population of 100 agents based on this joint probability matrix
-sample_population = generate_sample_population(joint_prob_matrix, 1000)
-
-# Save the result to csv file (OPTIONAL)
-sample_population.to_csv("/Users/stevenbickley/stevejbickley/data_assorted/" + str(extract_filename(original_data_path)) + "_samplePopulations_1k_world_sample.csv",index=False,encoding='utf-8')
-
-# Or... Generate sample populations for each country iteratively
-country_col = 'country_name' # 'ISO 3166-1 numeric country code'
-sample_populations = generate_country_sample_populations(agents_df, country_col, columns_of_interest, 100)
+    ## ---- From 'WVS_TimeSeries_1981_2022_Stata_v3_0_some_columns_renamed.csv':
 
-# Convert the sample populations dictionary to a dataframe
-sample_populations = convert_sample_populations_to_df(sample_populations)
+    # --> The "Core Set": ['Sex','Age','Ethnic group','Highest educational level attained','country_name']
+    # Possible alternatives to 'Age' variable/column: 'Year of birth', 'Age recoded (6 intervals)', 'Age recoded (3 intervals)'
+    # Possible alternatives to 'Highest educational level attained' variable/column: 'Highest educational level attained - Respondent ISCED-2011','Education level (recoded)','What age did you complete your education','What age did you complete your education (recoded in intervals)'
+    # Possible alternatives to 'country_name' variable/column: 'ISO 3166-1 alpha-3 country code','CoW country code alpha','Region ISO 3166-2','Region where the interview was conducted (WVS)','Settlement size','Settlement type where interview was conducted','Urban/Rural habitat','Type of habitat'
 
-# Save the result to csv file (OPTIONAL)
-sample_populations.to_csv("/Users/stevenbickley/stevejbickley/data_assorted/" + str(extract_filename(original_data_path)) + "_samplePopulations_100_per_country_sample.csv",index=False,encoding='utf-8')
+    # --> The "Wider Set": ['How many children do you have','Language of the interview','Employment status','Profession/job','Social class (subjective)','Marital status','Scale of incomes','Self positioning in political scale','Religious denominations - major groups']
+    # Note: we are missing/yet to add... --> sexual orientation, disability
+    # Possible alternatives to 'How many children do you have' variable/column: 'Have you had any children', 'How many are still living at home', 'Number of people in household'
+    # Possible alternatives to 'Language of the interview' variable/column: 'Language in which interview was conducted'
+    # Possible alternatives to 'Profession/job' variable/column: 'Respondent - Occupational group (WVS)', 'Chief wage earner profession/job'
+    # Possible alternatives to 'Social class (subjective)' variable/column: 'Social class (subjective) with 6 categories','Family savings during past year'
+    # Possible alternatives to 'Marital status' variable/column: 'Have you been married before'
+    # Possible alternatives to 'Scale of incomes' variable/column: 'Scale of incomes (Country specific)','Subjective income level (recoded in 3 groups)'
+    # Possible alternatives to 'Self positioning in political scale' variable/column: 'Political action: joining in boycotts','Political action recently done: joining in boycotts','Political action: attending lawful/peaceful demonstrations','Current society: Egalitarian vs. competitive society','Current society: Extensive welfare vs. low taxes','Current society: Regulated vs. responsible society','Society aimed: egalitarian vs. competitive','Society aimed: extensive welfare vs. low taxes'
+    # Possible alternatives to 'Religious denominations - major groups' variable/column: 'Belong to religious denomination', 'F025_WVS', 'Which former religious denomination', 'How often do you attend religious services', 'How often do you pray', 'Raised religiously','Important in life: Religion','Personal God vs. Spirit or Life Force','How important is God in your life','Get comfort and strength from religion','Neighbours: People of a different religion','Neighbours: People of the same religion','Sharing with partner: attitudes towards religion','Sharing with parents: attitudes towards religion','Moments of prayer, meditation...','Pray to God outside of religious services (I)','Pray to God outside of religious services (ii)','Politicians who don't believe in God are unfit for public office',''
 
-## ------ SECTION 3: Summary Statistics - Compare the distributions of the original vs synthetic populations' characteristics ------ ##
 
-# Compare the distributions
-def compare_distributions(original_data_path, column_names, sample_population):
-    original_joint_prob_matrix = create_joint_probability_matrix(original_data_path, column_names)
-    sample_joint_prob_matrix = create_joint_probability_matrix(sample_population, column_names)
-    print("Original Joint Probability Matrix:")
-    print(original_joint_prob_matrix)
-    print("\nSample Joint Probability Matrix:")
-    print(sample_joint_prob_matrix)
-    # Add further comparison logic or statistical analysis here
 
-# Example usage
-compare_distributions(original_data_path, columns_of_interest, sample_population)
-#compare_distributions(input_file_path, columns_of_interest, sample_population)
+    # --> The "Extended Set": ['Employment status - Respondent’s Spouse','Highest educational level attained - Respondent’s Father ISCED','Highest educational level attained - Respondent’s Mother ISCED','Respondent’s Father - Occupational group (when respondent was 14 years old)']
+    # Note: we are missing/yet to add... --> Respondent's Wealth/Socio-Economic Status/Living Situation During Childhood
+    # Possible alternatives to 'Highest educational level attained - Respondent’s Father ISCED' variable/column: 'Highest educational level attained - Respondent’s Father (Recoded)'
+    # Possible alternatives to 'Highest educational level attained - Respondent’s Mother ISCED' variable/column: 'Highest educational level attained - Respondent’s Mother (Recoded)'
+    # Possible alternatives to 'XXXX' variable/column: 'XXXX', 'XXXX', 'XXXX', 'XXXX'
+
+    ## ----
+
+    # For the other synthetic/real-world datasets:
+    # 'agents_output.xlsx' --> ['Age in years', 'Self-described gender', 'Highest level of education']
+    # 'CustomisedProfile_WVS_v2.xlsx' --> ['Sex (1=Male, 2=Female)', 'Age', 'Marital status (1=Married, 6=Single)']
+    # 'Integrated_values_surveys_1981-2021_decoded_dta2xlsx_python.csv' -->
 
-from scipy.stats import ks_2samp
+    # Generate the joint probability matrix
+    joint_prob_matrix = create_joint_probability_matrix(agents_df, columns_of_interest)
+    #joint_prob_matrix.index.nlevels
+    #joint_prob_matrix.columns.nlevels
+
+    # Now, generate a sample population of 100 agents based on this joint probability matrix
+    sample_population = generate_sample_population(joint_prob_matrix, 1000)
+
+    # Save the result to csv file (OPTIONAL)
+    sample_population.to_csv("/Users/stevenbickley/stevejbickley/data_assorted/" + str(extract_filename(original_data_path)) + "_samplePopulations_1k_world_sample.csv",index=False,encoding='utf-8')
+
+    # Or... Generate sample populations for each country iteratively (by country_col, set above)
+    sample_populations = generate_country_sample_populations(agents_df, country_col, columns_of_interest, 100)
+
+    # Convert the sample populations dictionary to a dataframe
+    sample_populations = convert_sample_populations_to_df(sample_populations)
+
+    # Save the result to csv file (OPTIONAL)
+    sample_populations.to_csv("/Users/stevenbickley/stevejbickley/data_assorted/" + str(extract_filename(original_data_path)) + "_samplePopulations_100_per_country_sample.csv",index=False,encoding='utf-8')
+
+    ## ------ SECTION 3: Summary Statistics - Compare the distributions of the original vs synthetic populations' characteristics ------ ##
+
+    # Example usage
+    compare_distributions(original_data_path, columns_of_interest, sample_population)
+    #compare_distributions(input_file_path, columns_of_interest, sample_population)
 
-# Kolmogorov-Smirnov Test (KS Test)
-# --> Good for numerical data (preferred continuous but can do discrete)
-def ks_test(original_data, synthetic_data, column_name):
-    ks_statistic, p_value = ks_2samp(original_data[column_name], synthetic_data[column_name])
-    return ks_statistic, p_value
-
-# Example usage
-ks_test(agents_df,sample_population,columns_of_interest)
+    # Example usage
+    ks_test(agents_df,sample_population,columns_of_interest)
 
-from scipy.stats import chi2_contingency
-import itertools
-
-# Function to perform pairwise chi-squared tests for a set of variables, using Bonferroni correction to adjust the p-values
-# --> Good for string or categorical distributions
-def perform_pairwise_chi_squared_tests(original_data, new_data, column_names):
-    results = {}
-    # For Bonferroni correction, count all pairwise comparisons
-    num_comparisons = len(column_names)
-    alpha = 0.05 / num_comparisons  # Adjust alpha for multiple testing
-    for column_name in column_names:
-        # Create contingency table for each column
-        original_freq = original_data[column_name].value_counts()
-        new_freq = new_data[column_name].value_counts()
-        # Make sure both Series have the same index for accurate comparison
-        combined_index = original_freq.index.union(new_freq.index)
-        original_freq = original_freq.reindex(combined_index, fill_value=0)
-        new_freq = new_freq.reindex(combined_index, fill_value=0)
-        contingency_table = pd.DataFrame({
-            'original': original_freq,
-            'new': new_freq
-        })
-        # Compute the chi-squared test
-        chi2, p_value, _, _ = chi2_contingency(contingency_table)
-        # Store results
-        results[column_name] = {'chi2': chi2, 'p_value': p_value, 'significant': p_value < alpha}
-    return results
+    perform_pairwise_chi_squared_tests(agents_df, sample_population, columns_of_interest)
 
-perform_pairwise_chi_squared_tests(agents_df, sample_population, columns_of_interest)
+    # Or... all marginal and pairwise comparisons (TVD, chi-squared and KS) as one tidy table
+    fidelity_report = distribution_fidelity_report(agents_df, sample_population, columns_of_interest, pairwise=True)
+    #fidelity_report.sort_values('tvd', ascending=False).head(20) # (OPTIONAL) The worst-reproduced columns and pairs
 
 ##### ------ MAIN CODE - END ------- ####
 
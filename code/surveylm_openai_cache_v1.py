@@ -0,0 +1,152 @@
+##### ------ IMPORT FUNCTIONS + SETUP CODE - START ------- ####
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+##### ------ DEFINE MAPPINGS - START ------- ####
+
+# Set SURVEYLM_OPENAI_CACHE=off to bypass the cache everywhere (e.g. to deliberately re-sample responses)
+CACHE_ENABLED = os.environ.get("SURVEYLM_OPENAI_CACHE", "on").lower() not in ("off", "0", "false", "no")
+
+# Where the shared response cache lives (override with the SURVEYLM_OPENAI_CACHE_PATH environment variable) and how big it may grow before
+# the least recently used responses are evicted (SURVEYLM_OPENAI_CACHE_MAX_BYTES)
+DEFAULT_CACHE_PATH = os.environ.get("SURVEYLM_OPENAI_CACHE_PATH", "./data/cache/openai_responses.sqlite")
+DEFAULT_CACHE_MAX_BYTES = int(os.environ.get("SURVEYLM_OPENAI_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+# Bump when the key recipe below changes, so that old entries are no longer matched
+CACHE_KEY_VERSION = 1
+
+##### ------ DEFINE FUNCTIONS - START ------- ####
+
+# Function to turn a response_format (a pydantic model class, a JSON-schema dict, or None) into something JSON-serialisable for the cache key
+def response_format_fingerprint(response_format):
+    if response_format is None or isinstance(response_format, (dict, str)):
+        return response_format
+    if hasattr(response_format, "model_json_schema"): # pydantic (v2) model class, as passed to client.beta.chat.completions.parse
+        return {"name": response_format.__name__, "schema": response_format.model_json_schema()}
+    return repr(response_format)
+
+# Function to compute the content-addressed key of one chat-completions request (model, messages, schema and sampling parameters)
+def request_cache_key(**request):
+    """
+    Parameters:
+    - request: The keyword arguments of the chat-completions call (model, messages, response_format, temperature, top_p, ...).
+    Returns:
+    - str: The sha256 hex digest of the canonical JSON of the request (keys sorted, so argument order doesn't matter).
+    """
+    request = dict(request)
+    request["response_format"] = response_format_fingerprint(request.get("response_format"))
+    canonical = json.dumps({"version": CACHE_KEY_VERSION, "request": request}, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class OpenAIResponseCache:
+    """
+    On-disk (SQLite) cache of chat-completions response contents, keyed by request_cache_key, shared by all the OpenAI extraction scripts.
+    Entries are evicted least recently used first once their total size exceeds max_bytes. Safe to use from several threads (one connection
+    behind a lock) and several processes (SQLite's own locking, in WAL mode).
+    """
+    __slots__ = ('path', 'max_bytes', 'hits', 'misses', 'connection', 'lock')
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT, size INTEGER, created REAL, last_access REAL, hit_count INTEGER DEFAULT 0)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+    def get(self, key):
+        # Returns the cached content (or None), and marks it as recently used
+        with self.lock:
+            row = self.connection.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET last_access = ?, hit_count = hit_count + 1 WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, content):
+        size = len(content.encode("utf-8"))
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, content, size, created, last_access, hit_count) VALUES (?, ?, ?, ?, ?, 0)", (key, content, size, now, now))
+            self.evict()
+
+    def evict(self):
+        # Deletes the least recently used entries until the cache fits in max_bytes (called with the lock held)
+        total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return 0
+        evicted = 0
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if total_bytes <= self.max_bytes:
+                break
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total_bytes -= size
+            evicted += 1
+        return evicted
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM responses")
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        # Hits and misses of this session, plus the size of the whole (shared) cache
+        with self.lock:
+            entries, total_bytes = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': entries, 'bytes': total_bytes, 'max_bytes': self.max_bytes, 'path': self.path}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+# Function to get the process-wide default cache (opened on first use, so importing this module touches no files)
+def get_default_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = OpenAIResponseCache()
+        return _default_cache
+
+# Function to make a chat-completions call through the cache, returning the content of its first choice
+def cached_completion_content(create_function, cache=None, **request):
+    """
+    Parameters:
+    - create_function (callable): The SDK call, e.g. client.beta.chat.completions.parse or client.chat.completions.create.
+    - cache (OpenAIResponseCache or False): The cache to use (defaults to get_default_cache()); False bypasses caching.
+    - request: The keyword arguments of the call (model, messages, response_format, temperature, ...), which also make up the cache key.
+    Returns:
+    - str: response.choices[0].message.content, from the cache if this exact request was answered before.
+    """
+    if cache is None and not CACHE_ENABLED:
+        cache = False
+    if cache is False:
+        return create_function(**request).choices[0].message.content
+    cache = cache if cache is not None else get_default_cache()
+    key = request_cache_key(**request)
+    content = cache.get(key)
+    if content is not None:
+        return content
+    content = create_function(**request).choices[0].message.content
+    if content: # Don't cache empty responses (e.g. refusals), so that they are retried next time
+        cache.put(key, content)
+    return content
+
+##### ------ DEFINE FUNCTIONS - END ------- ####
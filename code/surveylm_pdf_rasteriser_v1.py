@@ -0,0 +1,141 @@
+##### ------ IMPORT FUNCTIONS + SETUP CODE - START ------- ####
+
+import os
+import math
+import base64
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import fitz  # PyMuPDF
+
+##### ------ DEFINE MAPPINGS - START ------- ####
+
+# PyMuPDF colourspaces by name
+COLORSPACES = {"rgb": fitz.csRGB, "gray": fitz.csGRAY, "grey": fitz.csGRAY}
+
+# MIME type of each output format, for the data URLs sent to the chat-completions API
+IMAGE_MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "jpg": "image/jpeg"}
+
+##### ------ DEFINE FUNCTIONS - START ------- ####
+
+# Function to work out the resolution to render a page at, so that its longest side is at most max_dimension pixels (if given)
+def page_render_dpi(page, dpi=72, max_dimension=None):
+    if max_dimension is None:
+        return dpi
+    longest_side_points = max(page.rect.width, page.rect.height) # 72 points per inch
+    return min(dpi, max_dimension * 72 / longest_side_points)
+
+# Function to render one PDF page straight to PNG/JPEG bytes in memory (no temporary files, no PIL round trip)
+def render_page_image_bytes(page, dpi=72, colorspace="rgb", image_format="png", jpeg_quality=85, max_dimension=None):
+    """
+    Parameters:
+    - page (fitz.Page): The page to render.
+    - dpi (int): Rendering resolution (72 = PyMuPDF's default of one pixel per point).
+    - colorspace (str): 'rgb' or 'gray' (grayscale roughly thirds the payload of text-only pages).
+    - image_format (str): 'png' (lossless) or 'jpeg' (much smaller for scanned or photographic pages).
+    - jpeg_quality (int): JPEG quality (1-100), if image_format is 'jpeg'.
+    - max_dimension (int, optional): Downscale (by rendering at a lower resolution) so the longest side is at most this many pixels.
+    Returns:
+    - bytes: The encoded image.
+    """
+    zoom = page_render_dpi(page, dpi, max_dimension) / 72
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=COLORSPACES[colorspace.lower()], alpha=False)
+    if image_format.lower() in ("jpeg", "jpg"):
+        return pix.tobytes(output="jpeg", jpg_quality=jpeg_quality)
+    return pix.tobytes(output="png")
+
+# Function to lazily yield the base64 image of each page (in page order), so that a long document is never held in memory all at once
+def iter_pdf_base64_images(pdf_path, dpi=72, colorspace="rgb", image_format="png", jpeg_quality=85, max_dimension=None, start_page=0, end_page=None):
+    """
+    Parameters:
+    - pdf_path (str): Path to the PDF.
+    - dpi, colorspace, image_format, jpeg_quality, max_dimension: Rendering options (see render_page_image_bytes).
+    - start_page (int): First page to render (0-based).
+    - end_page (int, optional): Page to stop before (defaults to the end of the document).
+    Returns:
+    - generator: The base64 (utf-8 str) image of each page.
+    """
+    with fitz.open(pdf_path) as pdf_document:
+        yield from iter_document_base64_images(pdf_document, start_page, end_page, dpi=dpi, colorspace=colorspace, image_format=image_format,
+                                               jpeg_quality=jpeg_quality, max_dimension=max_dimension)
+
+# Function to lazily yield the base64 image of each page of an already-open document, from start_page up to (not including) end_page
+def iter_document_base64_images(pdf_document, start_page=0, end_page=None, **render_options):
+    end_page = len(pdf_document) if end_page is None else min(end_page, len(pdf_document))
+    for page_num in range(start_page, end_page):
+        image_bytes = render_page_image_bytes(pdf_document.load_page(page_num), **render_options)
+        yield base64.b64encode(image_bytes).decode("utf-8")
+
+# Function to render all pages of a PDF to base64 images (a list; use iter_pdf_base64_images to stream them instead)
+def pdf_to_base64_images(pdf_path, dpi=72, colorspace="rgb", image_format="png", jpeg_quality=85, max_dimension=None, start_page=0, end_page=None):
+    return list(iter_pdf_base64_images(pdf_path, dpi=dpi, colorspace=colorspace, image_format=image_format, jpeg_quality=jpeg_quality,
+                                       max_dimension=max_dimension, start_page=start_page, end_page=end_page))
+
+# The document open in this worker process (each worker opens its own copy, as PyMuPDF documents can't be shared across processes)
+_worker_pdf_document = None
+
+# Function to open the document once per worker process (the process pool's initializer)
+def open_worker_pdf_document(pdf_path):
+    global _worker_pdf_document
+    _worker_pdf_document = fitz.open(pdf_path)
+
+# Function (run in a worker process) to render one contiguous range of pages of the worker's document
+def render_worker_page_range(start_page, end_page, render_options):
+    return list(iter_document_base64_images(_worker_pdf_document, start_page, end_page, **render_options))
+
+# Function to split pages [start_page, end_page) into contiguous ranges of (at most) pages_per_task pages
+def split_page_range(start_page, end_page, pages_per_task):
+    starts = list(range(start_page, end_page, pages_per_task))
+    return starts, [min(start + pages_per_task, end_page) for start in starts]
+
+# Function to render a document's pages across a pool of processes, yielding the base64 images in page order
+def iter_pdf_base64_images_parallel(pdf_path, max_workers=None, pages_per_task=None, start_page=0, end_page=None, **render_options):
+    """
+    Parameters:
+    - pdf_path (str): Path to the PDF.
+    - max_workers (int, optional): Number of worker processes (defaults to the number of cores); 1 renders in this process.
+    - pages_per_task (int, optional): Pages per task (defaults to about four tasks per worker, to balance pages of uneven complexity).
+    - start_page (int): First page to render (0-based).
+    - end_page (int, optional): Page to stop before (defaults to the end of the document).
+    - render_options: dpi, colorspace, image_format, jpeg_quality and/or max_dimension (see render_page_image_bytes).
+    Returns:
+    - generator: The base64 image of each page, in page order.
+    """
+    with fitz.open(pdf_path) as pdf_document:
+        end_page = len(pdf_document) if end_page is None else min(end_page, len(pdf_document))
+    num_pages = max(0, end_page - start_page)
+    max_workers = min(max_workers or os.cpu_count() or 1, num_pages)
+    if max_workers <= 1: # Not worth starting processes for
+        yield from iter_pdf_base64_images(pdf_path, start_page=start_page, end_page=end_page, **render_options)
+        return
+    pages_per_task = pages_per_task or max(1, math.ceil(num_pages / (4 * max_workers)))
+    starts, ends = split_page_range(start_page, end_page, pages_per_task)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=open_worker_pdf_document, initargs=(pdf_path,)) as executor:
+        # executor.map returns the ranges' results in submission (i.e. page) order, whatever order they finish in
+        for page_images in executor.map(render_worker_page_range, starts, ends, itertools.repeat(render_options)):
+            yield from page_images
+
+# Function to render all pages of a PDF to base64 images across a pool of processes (a list, in page order)
+def pdf_to_base64_images_parallel(pdf_path, max_workers=None, pages_per_task=None, start_page=0, end_page=None, **render_options):
+    return list(iter_pdf_base64_images_parallel(pdf_path, max_workers=max_workers, pages_per_task=pages_per_task, start_page=start_page,
+                                                end_page=end_page, **render_options))
+
+# Function to read the (width, height) in pixels of a base64 PNG or JPEG image from its header, without decoding the pixels
+def base64_image_dimensions(base64_image):
+    if base64_image.startswith("iVBOR"): # PNG: the IHDR chunk (width, height as big-endian uint32) starts right after the 8-byte signature
+        header = base64.b64decode(base64_image[:44])
+        return int.from_bytes(header[16:20], "big"), int.from_bytes(header[20:24], "big")
+    image_bytes = base64.b64decode(base64_image)
+    position = 2 # JPEG: walk the marker segments (after the FF D8 start-of-image marker) up to the start-of-frame segment
+    while position + 9 < len(image_bytes):
+        marker, segment_length = image_bytes[position + 1], int.from_bytes(image_bytes[position + 2:position + 4], "big")
+        if marker in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF): # SOFn markers carry height then width
+            return int.from_bytes(image_bytes[position + 7:position + 9], "big"), int.from_bytes(image_bytes[position + 5:position + 7], "big")
+        position += 2 + segment_length
+    raise ValueError("Could not read the image dimensions (expected a PNG or JPEG image).")
+
+# Function to build the data URL of a base64 image for the chat-completions API (the MIME type is sniffed from the image's first bytes)
+def base64_image_data_url(base64_image):
+    mime_type = IMAGE_MIME_TYPES["jpeg"] if base64_image.startswith("/9j/") else IMAGE_MIME_TYPES["png"] # JPEG files start with FF D8 FF
+    return f"data:{mime_type};base64,{base64_image}"
+
+##### ------ DEFINE FUNCTIONS - END ------- ####
@@ -0,0 +1,172 @@
+##### ------ IMPORT FUNCTIONS + SETUP CODE - START ------- ####
+
+import os
+import sys
+import json
+import threading
+import types
+import hashlib
+import tempfile
+import httpx
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from openai import APIConnectionError
+
+# Point the generator's client at a local stub before importing it (the client reads these when it is created)
+os.environ.setdefault("OPENAI_API_KEY", "sk-local-stub")
+os.environ["SURVEYLM_OPENAI_CACHE"] = "off" # Every request must reach the fake/stub, and nothing gets written to the shared response cache
+STUB_SERVER = ThreadingHTTPServer(("127.0.0.1", 0), BaseHTTPRequestHandler) # Handler set below; bound now so that the port is known
+os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{STUB_SERVER.server_address[1]}/v1"
+
+# Import the question generator from the same folder (whatever the working directory)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import surveylm_question_table_generator_v11 as generator
+from surveylm_pdf_rasteriser_v1 import pdf_to_base64_images
+
+##### ------ DEFINE FUNCTIONS - START ------- ####
+
+# Function to build a QuestionExtraction (reflection schema) JSON reply with one question per page it was extracted from
+def stub_extraction_content(page_labels):
+    items = [{"question": f"Question on {page_label}", "question_id": page_label, "answer_instruction": "Answer freely.",
+              "data_information_knowledge_and_context": "", "reasoning_justification_relevant": ""} for page_label in page_labels]
+    return json.dumps({"draft_items": items, "instruction_completeness": "100", "ambiguity": "0", "logical_consistency": "100", "option_completeness": "100",
+                       "final_items": [{key: item[key] for key in ("question", "question_id", "answer_instruction")} for item in items]})
+
+# Function to find the page labels (the fake base64 images, or digests of real ones) in a chat-completions request's messages
+def page_labels_from_messages(messages):
+    return [page_label(part["image_url"]["url"].split("base64,", 1)[1]) for part in messages[1]["content"] if part.get("type") == "image_url"]
+
+# Function to label a page by its base64 image (short fake images as they are, rendered pages by a digest)
+def page_label(base64_image):
+    return base64_image if len(base64_image) <= 32 else hashlib.sha1(base64_image.encode("utf-8")).hexdigest()[:16]
+
+# Function to swap the generator's client for one whose beta.chat.completions.parse is fake_create (and whose with_options returns itself)
+def use_fake_client(fake_create):
+    fake_client = types.SimpleNamespace(beta=types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(parse=fake_create))))
+    fake_client.with_options = lambda **options: fake_client
+    generator.client = fake_client
+
+# Function to make a fake client.beta.chat.completions.parse that fails the first failures_per_page calls of each request (its pages) with a transient error
+def make_fake_create(failures_per_page):
+    calls, lock = {}, threading.Lock()
+    def fake_create(**request):
+        page_labels = page_labels_from_messages(request["messages"])
+        with lock:
+            calls[",".join(page_labels)] = calls.get(",".join(page_labels), 0) + 1
+            attempt = calls[",".join(page_labels)]
+        if attempt <= failures_per_page:
+            raise APIConnectionError(request=httpx.Request("POST", "http://fake/chat/completions"))
+        message = types.SimpleNamespace(content=stub_extraction_content(page_labels))
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+    return fake_create, calls
+
+# Class handling the local stub's POST /v1/chat/completions, answering 503 to the first failures_per_page requests of each page
+class StubChatCompletionsHandler(BaseHTTPRequestHandler):
+    failures_per_page = 1
+    calls = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        request_pages = ",".join(page_labels_from_messages(request["messages"]))
+        with self.lock:
+            self.calls[request_pages] = self.calls.get(request_pages, 0) + 1
+            attempt = self.calls[request_pages]
+        if attempt <= self.failures_per_page:
+            self.send_json(503, {"error": {"message": "stub overloaded", "type": "server_error"}})
+            return
+        self.send_json(200, {"id": "chatcmpl-stub", "object": "chat.completion", "created": 0, "model": request["model"],
+                             "choices": [{"index": 0, "finish_reason": "stop", "logprobs": None,
+                                          "message": {"role": "assistant", "content": stub_extraction_content(request_pages.split(",")), "refusal": None}}],
+                             "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}})
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+# Function to check that every page comes back once, in page order, after the expected number of attempts
+def check_page_results(page_results, page_labels, calls, expected_attempts):
+    extracted_labels = [json.loads(page_json)["final_items"][0]["question_id"] for page_json in page_results]
+    assert extracted_labels == page_labels, f"Pages out of order or missing: {extracted_labels}"
+    assert all(calls[page_label] == expected_attempts for page_label in page_labels), f"Unexpected attempts per page: {calls}"
+
+# Function to run extract_pages_concurrently (and so call_with_retries) over fake pages against a fake create callable
+def check_with_fake_create(num_pages=12, max_workers=4, failures_per_page=2):
+    page_labels = [f"page-{page_num}" for page_num in range(num_pages)]
+    fake_create, calls = make_fake_create(failures_per_page)
+    real_client = generator.client
+    use_fake_client(fake_create)
+    try:
+        page_results = generator.extract_pages_concurrently(page_labels, max_workers=max_workers, max_retries=failures_per_page, backoff_seconds=0.01)
+    finally:
+        generator.client = real_client
+    check_page_results(page_results, page_labels, calls, failures_per_page + 1)
+    # One retry fewer than needed: every page gives up and comes back as None, without stopping the others
+    fake_create, calls = make_fake_create(failures_per_page)
+    use_fake_client(fake_create)
+    try:
+        page_results = generator.extract_pages_concurrently(page_labels, max_workers=max_workers, max_retries=failures_per_page - 1, backoff_seconds=0.01)
+    finally:
+        generator.client = real_client
+    assert page_results == [None] * num_pages, page_results
+    print(f"Fake create: {num_pages} pages in order after {failures_per_page} transient failures each; exhausted retries give None")
+
+# Function to run extract_pages_concurrently through the real OpenAI client against the local chat-completions stub
+def check_with_local_stub(num_pages=12, max_workers=4, failures_per_page=1):
+    page_labels = [f"page-{page_num}" for page_num in range(num_pages)]
+    StubChatCompletionsHandler.failures_per_page = failures_per_page
+    StubChatCompletionsHandler.calls = {}
+    STUB_SERVER.RequestHandlerClass = StubChatCompletionsHandler
+    server_thread = threading.Thread(target=STUB_SERVER.serve_forever, daemon=True)
+    server_thread.start()
+    try:
+        page_results = generator.extract_pages_concurrently(page_labels, max_workers=max_workers, max_retries=failures_per_page, backoff_seconds=0.01)
+    finally:
+        STUB_SERVER.shutdown()
+    # With the SDK's retries off for the page requests, each page is attempted exactly failures_per_page + 1 times (by call_with_retries alone),
+    # while the shared client (e.g. for extract_questions_from_text and transform_data_into_schema) keeps the SDK's default retries
+    check_page_results(page_results, page_labels, StubChatCompletionsHandler.calls, failures_per_page + 1)
+    assert generator.client.max_retries > 0, "The shared client's retries must stay on"
+    print(f"Local stub at {os.environ['OPENAI_BASE_URL']}: {num_pages} pages in order after {failures_per_page} 503 each")
+
+# Function to run main_extract (pages rendered across a process pool, then extracted concurrently, page by page or in budgeted batches) over real PDFs
+# against a fake create callable
+def check_main_extract_with_fake_create(read_path, max_workers=2, batched=True):
+    fake_create, calls = make_fake_create(failures_per_page=0)
+    real_client = generator.client
+    use_fake_client(fake_create)
+    try:
+        with tempfile.TemporaryDirectory() as write_path:
+            generator.main_extract(read_path, write_path, max_workers=max_workers, batched=batched)
+            for filename in sorted(os.listdir(read_path)):
+                if filename.endswith(".pdf"):
+                    # The serial renderer's pages, in order, are what the pooled pipeline must have extracted
+                    expected_labels = [page_label(base64_image) for base64_image in pdf_to_base64_images(os.path.join(read_path, filename))]
+                    with open(os.path.join(write_path, filename.replace(".pdf", "_extracted.json")), encoding="utf-8") as f:
+                        extraction = json.load(f)
+                    if batched: # One merged QuestionExtraction for the whole document, with each reflection score averaged across the batches
+                        extracted_labels = [item["question_id"] for item in extraction["final_items"]]
+                        assert (extraction["ambiguity"], extraction["instruction_completeness"]) == ("0", "100"), f"{filename}: reflection scores not averaged"
+                    else: # One QuestionExtraction per page
+                        extracted_labels = [page["final_items"][0]["question_id"] for page in extraction]
+                    assert extracted_labels == expected_labels, f"{filename}: pages out of order or missing"
+                    print(f"main_extract (batched={batched}): {filename} ({len(expected_labels)} pages) rendered across {max_workers} processes and extracted in order")
+    finally:
+        generator.client = real_client
+
+##### ------ MAIN CODE - START ------- ####
+
+if __name__ == "__main__":
+    check_with_fake_create()
+    check_with_local_stub()
+    pdfs_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "inputs", "pdfs")
+    check_main_extract_with_fake_create(pdfs_path, batched=False)
+    check_main_extract_with_fake_create(pdfs_path, batched=True)
+
+##### ------ MAIN CODE - END ------- ####
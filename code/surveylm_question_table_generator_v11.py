@@ -1,17 +1,24 @@
 ##### ------ IMPORT FUNCTIONS + SETUP CODE - START ------- ####
 
 from pydantic import BaseModel
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError, APITimeoutError, RateLimitError, InternalServerError
 #from enum import Enum
 from typing import Optional
-import fitz  # PyMuPDF
-import io
 import os
-from PIL import Image
 import base64
 import json
+import math
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2 # (Optional)
 import pandas as pd
+import sys
+
+# Shared on-disk cache of OpenAI responses and PDF rasteriser, imported from the same folder (whatever the working directory)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from surveylm_openai_cache_v1 import cached_completion_content
+from surveylm_pdf_rasteriser_v1 import pdf_to_base64_images_parallel, base64_image_data_url, base64_image_dimensions
 
 ### --- Planned Updates, Wish List, Random Thoughts/Ideas Log: --- ###
 
@@ -31,8 +38,22 @@ import pandas as pd
 ##### ------ DEFINE FUNCTIONS - START ------- ####
 
 
+# Reads OPENAI_API_KEY and (optionally) OPENAI_BASE_URL, e.g. to point at a local stub of the chat-completions endpoint for testing.
+# Keeps the SDK's default retries; the concurrent page extraction turns them off for its own requests (see extract_pages_concurrently).
 client = OpenAI()
 
+# Default request budgets for the batched multi-image extraction: image input tokens per request (well under the model's context window,
+# leaving room for the prompt and the structured output), payload bytes per request (under the API's request size limit) and pages per request
+MAX_IMAGE_TOKENS_PER_BATCH = 20000
+MAX_BYTES_PER_BATCH = 8 * 1024 * 1024
+MAX_PAGES_PER_BATCH = 20
+
+# Reflection-schema scores (0 to 100, returned as strings), which are averaged across batches rather than joined like the free-text fields
+REFLECTION_SCORE_FIELDS = ("instruction_completeness", "ambiguity", "logical_consistency", "option_completeness")
+
+# Errors worth retrying (connection drops, timeouts, rate limits and 5xx responses), as opposed to e.g. bad requests or schema errors
+TRANSIENT_OPENAI_ERRORS = (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError)
+
 # SDKs for structured response extraction
 
 # Define BASIC item schema (old/decommissioned)
@@ -185,7 +206,7 @@ def extract_questions_from_text(text_input, question_type="", temperature_settin
     # The final user message prompt
     user_message = f"{user_content} Here is the supplied text: {text_input}. {end_content}"
     #response = client.chat.completions.create(
-    response = client.beta.chat.completions.parse(
+    response_content = cached_completion_content(client.beta.chat.completions.parse,
         model=model_setting,
         #response_format={"type": "json_object"},
         messages=[
@@ -211,38 +232,11 @@ def extract_questions_from_text(text_input, question_type="", temperature_settin
         #logit_bias=logit_bias_setting,
         logprobs=logprobs_setting,
     )
-    return response.choices[0].message.content
-
-
-# Encoding images as base64 for input to OpenAI chat completions API
-@staticmethod
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
-
-
-def pdf_to_base64_images(pdf_path):
-    #Handles PDFs with multiple pages
-    pdf_document = fitz.open(pdf_path)
-    base64_images = []
-    temp_image_paths = []
-    total_pages = len(pdf_document)
-    for page_num in range(total_pages):
-        page = pdf_document.load_page(page_num)
-        pix = page.get_pixmap()
-        img = Image.open(io.BytesIO(pix.tobytes()))
-        temp_image_path = f"temp_page_{page_num}.png"
-        img.save(temp_image_path, format="PNG")
-        temp_image_paths.append(temp_image_path)
-        base64_image = encode_image(temp_image_path)
-        base64_images.append(base64_image)
-    for temp_image_path in temp_image_paths:
-        os.remove(temp_image_path)
-    return base64_images
+    return response_content
 
 
 # In the extract_invoice_data function, modify the system prompt to extract relevant CV data such as name, contact information, work experience, education, skills, etc.
-def extract_questions_from_image(base64_image, question_type="", temperature_setting=0.7, max_tokens_setting=None, top_p_setting=1, presence_penalty_setting=0, n_setting=1, frequency_penalty_setting=0, logprobs_setting=False, model_setting="gpt-4o-mini", chain_of_thought=True, hendrick_context_framework=False, bickley_context_framework=False, reflection=True, guiding_principles="clear, simple/intuitive and easy to understand; short/concise"): # Spare/unused from OpenAI: stop_setting=[], logit_bias_setting=[],
+def extract_questions_from_image(base64_image, question_type="", temperature_setting=0.7, max_tokens_setting=None, top_p_setting=1, presence_penalty_setting=0, n_setting=1, frequency_penalty_setting=0, logprobs_setting=False, model_setting="gpt-4o-mini", chain_of_thought=True, hendrick_context_framework=False, bickley_context_framework=False, reflection=True, guiding_principles="clear, simple/intuitive and easy to understand; short/concise", openai_client=None): # Spare/unused from OpenAI: stop_setting=[], logit_bias_setting=[],
     """
     Extracts 'question' and 'answer instruction' pairs from a base64-encoded image (PDF)
     using OCR, and outputs structured data in JSON format for machine learning datasets.
@@ -255,6 +249,7 @@ def extract_questions_from_image(base64_image, question_type="", temperature_set
     - hendrick_context_framework (bool): Include Hendrick context if True.
     - bickley_context_framework (bool): Include Bickley context if True.
     - guiding_principles (str): Customizable guiding principles for the output. E.g., "Clear, simple/intuitive and easy to understand; short/concise", "Detailed and informative, with nuanced explanations and context for deeper understanding.", "Critical and analytical, highlighting key implications and dissecting complex ideas.", "Objective and neutral, presenting balanced perspectives without bias or opinion.", "Engaging and conversational, designed to be approachable and easy to follow, with a friendly tone.", "Concise yet comprehensive, ensuring brevity without losing critical details.", "Fact-driven and evidence-based, grounded in accurate data and reliable sources.", "Creative and explorative, pushing the boundaries of traditional thinking and encouraging innovative ideas.", "Clear and practical, using real-world examples to illustrate complex ideas.", "Ethically responsible, ensuring that responses adhere to moral standards and promote fairness.", "Strategic and goal-oriented, with a focus on practical outcomes and actionable steps.", Thought-provoking and open-ended, encouraging deeper exploration and reflective thinking.", "Polished and professional, adhering to formal standards with well-structured, authoritative responses."
+    - openai_client (OpenAI, optional): The client to send the request with (defaults to the module's client).
     Returns:
     - dict: Extracted structured data in JSON format.
     """
@@ -342,7 +337,7 @@ def extract_questions_from_image(base64_image, question_type="", temperature_set
     # The final user message prompt
     user_message = f"{user_content}.{end_content}"
     #response = client.chat.completions.create(
-    response = client.beta.chat.completions.parse(
+    response_content = cached_completion_content((openai_client or client).beta.chat.completions.parse,
         model=model_setting,
         #response_format={"type": "json_object"},
         messages=[
@@ -355,7 +350,7 @@ def extract_questions_from_image(base64_image, question_type="", temperature_set
                 "content": [
                     {"type": "text", "text": user_message},
                     {"type": "image_url",
-                     "image_url": {"url": f"data:image/png;base64,{base64_image}", "detail": "high"}}
+                     "image_url": {"url": base64_image_data_url(base64_image), "detail": "high"}}
                 ]
             }
         ],
@@ -370,11 +365,11 @@ def extract_questions_from_image(base64_image, question_type="", temperature_set
         #logit_bias=logit_bias_setting,
         logprobs=logprobs_setting,
     )
-    return response.choices[0].message.content
+    return response_content
 
 
 
-def extract_questions_from_images(base64_images, question_type="", temperature_setting=0.7, max_tokens_setting=None, top_p_setting=1, presence_penalty_setting=0, n_setting=1, frequency_penalty_setting=0, logprobs_setting=False, model_setting="gpt-4o-mini", chain_of_thought=True, hendrick_context_framework=False, bickley_context_framework=False, reflection=True, guiding_principles="clear, simple/intuitive and easy to understand; short/concise"): # Spare/unused from OpenAI: stop_setting=[], logit_bias_setting=[],
+def extract_questions_from_images(base64_images, question_type="", temperature_setting=0.7, max_tokens_setting=None, top_p_setting=1, presence_penalty_setting=0, n_setting=1, frequency_penalty_setting=0, logprobs_setting=False, model_setting="gpt-4o-mini", chain_of_thought=True, hendrick_context_framework=False, bickley_context_framework=False, reflection=True, guiding_principles="clear, simple/intuitive and easy to understand; short/concise", openai_client=None): # Spare/unused from OpenAI: stop_setting=[], logit_bias_setting=[],
     """
     Extracts 'question' and 'answer instruction' pairs from a list of base64-encoded images (PDF)
     using OCR, and outputs structured data in JSON format for machine learning datasets.
@@ -387,6 +382,7 @@ def extract_questions_from_images(base64_images, question_type="", temperature_s
     - hendrick_context_framework (bool): Include Hendrick context if True.
     - bickley_context_framework (bool): Include Bickley context if True.
     - guiding_principles (str): Customizable guiding principles for the output. E.g., "Clear, simple/intuitive and easy to understand; short/concise", "Detailed and informative, with nuanced explanations and context for deeper understanding.", "Critical and analytical, highlighting key implications and dissecting complex ideas.", "Objective and neutral, presenting balanced perspectives without bias or opinion.", "Engaging and conversational, designed to be approachable and easy to follow, with a friendly tone.", "Concise yet comprehensive, ensuring brevity without losing critical details.", "Fact-driven and evidence-based, grounded in accurate data and reliable sources.", "Creative and explorative, pushing the boundaries of traditional thinking and encouraging innovative ideas.", "Clear and practical, using real-world examples to illustrate complex ideas.", "Ethically responsible, ensuring that responses adhere to moral standards and promote fairness.", "Strategic and goal-oriented, with a focus on practical outcomes and actionable steps.", Thought-provoking and open-ended, encouraging deeper exploration and reflective thinking.", "Polished and professional, adhering to formal standards with well-structured, authoritative responses."
+    - openai_client (OpenAI, optional): The client to send the request with (defaults to the module's client).
     Returns:
     - dict: Extracted structured data in JSON format.
     """
@@ -492,20 +488,17 @@ def extract_questions_from_images(base64_images, question_type="", temperature_s
         messages[1]["content"].append({
             "type": "image_url",
             "image_url": {
-                "url": f"data:image/png;base64,{base64_image}",
+                "url": base64_image_data_url(base64_image),
                 "detail": "high"
             }
         })
-    # Add the main task description as the second part of the message
+    # Add the main task description as the last part of the message
     messages[1]["content"].append({
-        "role": "user",
-        "content": [
-            {"type": "text",
-             "text": user_message}
-        ]
+        "type": "text",
+        "text": user_message
     })
     #response = client.chat.completions.create(
-    response = client.beta.chat.completions.parse(
+    response_content = cached_completion_content((openai_client or client).beta.chat.completions.parse,
         model=model_setting,
         #response_format={"type": "json_object"},
         messages=messages,
@@ -520,13 +513,66 @@ def extract_questions_from_images(base64_images, question_type="", temperature_s
         #logit_bias=logit_bias_setting,
         logprobs=logprobs_setting,
     )
-    return response.choices[0].message.content
+    return response_content
+
 
+# Calling a function (e.g. one OpenAI request) with retries and exponential backoff (with jitter) on transient errors
+def call_with_retries(function, *args, max_retries=4, backoff_seconds=1.0, max_backoff_seconds=30.0, transient_errors=TRANSIENT_OPENAI_ERRORS, **kwargs):
+    """
+    Parameters:
+    - function (callable): The function to call, with *args and **kwargs.
+    - max_retries (int): Maximum number of retries after the first attempt.
+    - backoff_seconds (float): Wait before the first retry, doubled on each further retry (plus up to 100% random jitter).
+    - max_backoff_seconds (float): Cap on the wait between two attempts.
+    - transient_errors (tuple): Exception types to retry; anything else is raised straight away.
+    Returns:
+    - The function's return value (the last transient error is raised once the retries are used up).
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return function(*args, **kwargs)
+        except transient_errors as error:
+            if attempt == max_retries:
+                raise
+            wait_seconds = min(max_backoff_seconds, backoff_seconds * 2 ** attempt) * (1 + random.random())
+            print(f"Transient error ({type(error).__name__}: {error}); retrying in {wait_seconds:.1f}s (attempt {attempt + 2} of {max_retries + 1})")
+            time.sleep(wait_seconds)
 
-def extract_from_multiple_pages(base64_images, original_filename, output_directory, guiding_principles="Clear, simple/intuitive and easy to understand; short/concise; fact-driven and evidence-based, grounded in accurate data and reliable sources."):
+
+# Extracting questions from each page (base64 image) concurrently, with up to max_workers requests in flight at once
+def extract_pages_concurrently(base64_images, extract_function=None, max_workers=8, max_retries=4, backoff_seconds=1.0, **extract_kwargs):
+    """
+    Parameters:
+    - base64_images (iterable): The base64 page images (e.g. from pdf_to_base64_images), in page order.
+    - extract_function (callable): The per-page extraction function, called as extract_function(base64_image, **extract_kwargs) (defaults to extract_questions_from_image).
+    - max_workers (int): Maximum number of concurrent page requests.
+    - max_retries (int): Maximum number of retries per page on transient errors (see call_with_retries).
+    - backoff_seconds (float): Wait before a page's first retry (doubled on each further retry).
+    - extract_kwargs: Further keyword arguments passed to extract_function (e.g. model_setting, temperature_setting).
+    Returns:
+    - list: The extraction result of each page, in page order (None for pages that failed after all retries).
+    """
+    if extract_function is None:
+        extract_function = extract_questions_from_image
+    if extract_function in (extract_questions_from_image, extract_questions_from_images) and 'openai_client' not in extract_kwargs:
+        # The SDK's own retries are off for these requests, so that call_with_retries is the only retry layer and max_retries means what it says
+        extract_kwargs['openai_client'] = client.with_options(max_retries=0)
+    # Function to extract one page, so that one page's (non-transient or exhausted) failure doesn't lose the other pages
+    def extract_page(page_num, base64_image):
+        try:
+            return call_with_retries(extract_function, base64_image, max_retries=max_retries, backoff_seconds=backoff_seconds, **extract_kwargs)
+        except Exception as error:
+            print(f"Page {page_num + 1} failed: {type(error).__name__}: {error}")
+            return None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(extract_page, page_num, base64_image) for page_num, base64_image in enumerate(base64_images)]
+        return [future.result() for future in futures] # Collected in submission (i.e. page) order, whatever order they finish in
+
+
+def extract_from_multiple_pages(base64_images, original_filename, output_directory, guiding_principles="Clear, simple/intuitive and easy to understand; short/concise; fact-driven and evidence-based, grounded in accurate data and reliable sources.", max_workers=8, max_retries=4, extract_function=None):
     entire_invoice = []
-    for base64_image in base64_images:
-        invoice_json = extract_questions_from_image(base64_image, model_setting="gpt-4o-2024-08-06", guiding_principles=guiding_principles, temperature_setting=0.2)
+    page_results = extract_pages_concurrently(base64_images, extract_function=extract_function, max_workers=max_workers, max_retries=max_retries, model_setting="gpt-4o-2024-08-06", guiding_principles=guiding_principles, temperature_setting=0.2)
+    for invoice_json in page_results:
         # Check if the result is None/empty or if it is NOT an instance of str, bytes, or bytearray
         if not invoice_json: # or not isinstance(invoice_json, (str, bytes, bytearray)):
             continue # If yes, skip this iteration or step
@@ -542,12 +588,119 @@ def extract_from_multiple_pages(base64_images, original_filename, output_directo
     return output_filename
 
 
-def extract_from_multiple_pages(base64_images, original_filename, output_directory, guiding_principles="Clear, simple/intuitive and easy to understand; short/concise; fact-driven and evidence-based, grounded in accurate data and reliable sources."):
-    invoice_json = extract_questions_from_images(base64_images, model_setting="gpt-4o-2024-08-06", guiding_principles=guiding_principles, temperature_setting=0.2)
-    # Check if the result is None/empty or if it is NOT an instance of str, bytes, or bytearray
-    if not invoice_json: # or not isinstance(invoice_json, (str, bytes, bytearray)):
-        continue # If yes, skip this iteration or step
-    invoice_data = json.loads(invoice_json)
+# Estimating the input tokens of one image, from its resolution (OpenAI's vision pricing: 85 base tokens, plus 170 per 512px tile at 'high' detail)
+def estimate_image_tokens(base64_image, detail="high"):
+    if detail == "low":
+        return 85
+    width, height = base64_image_dimensions(base64_image)
+    # The image is first scaled (down) to fit in 2048 x 2048, then (down) so that its shortest side is at most 768px
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 85 + 170 * tiles
+
+
+# Packing consecutive pages into request batches, each under a token, byte and page budget (pages stay in order, within and across batches)
+def batch_pages_by_budget(base64_images, max_tokens=MAX_IMAGE_TOKENS_PER_BATCH, max_bytes=MAX_BYTES_PER_BATCH, max_pages=MAX_PAGES_PER_BATCH, detail="high"):
+    """
+    Parameters:
+    - base64_images (list): The base64 page images, in page order.
+    - max_tokens (int): Maximum estimated image input tokens per batch (see estimate_image_tokens).
+    - max_bytes (int): Maximum image payload (base64 data URL) bytes per batch.
+    - max_pages (int, optional): Maximum pages per batch (None for no limit).
+    - detail (str): The image detail level the requests use ('high' or 'low').
+    Returns:
+    - list: One list of page numbers (0-based) per batch. A page that is over budget on its own gets a batch of its own.
+    """
+    batches = []
+    current_batch, current_tokens, current_bytes = [], 0, 0
+    for page_num, base64_image in enumerate(base64_images):
+        page_tokens = estimate_image_tokens(base64_image, detail=detail)
+        page_bytes = len(base64_image_data_url(base64_image))
+        over_budget = current_tokens + page_tokens > max_tokens or current_bytes + page_bytes > max_bytes or (max_pages is not None and len(current_batch) >= max_pages)
+        if current_batch and over_budget:
+            batches.append(current_batch)
+            current_batch, current_tokens, current_bytes = [], 0, 0
+        current_batch.append(page_num)
+        current_tokens += page_tokens
+        current_bytes += page_bytes
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+
+# Averaging the batches' scores of one reflection field (see REFLECTION_SCORE_FIELDS), e.g. "85" and "90" give "87.5"
+def average_scores(scores):
+    values = []
+    for score in scores:
+        try:
+            values.append(float(str(score).strip().rstrip("%")))
+        except ValueError: # Not a number (e.g. "N/A"), so left out of the average
+            continue
+    if not values:
+        return "; ".join(dict.fromkeys(str(score) for score in scores))
+    return f"{sum(values) / len(values):.4g}"
+
+
+# Merging the structured results (parsed QuestionExtraction dicts) of several batches into one result with the same schema
+def merge_structured_extractions(results, field_name=None):
+    """
+    Parameters:
+    - results (list): The parsed results of each batch, in batch (i.e. page) order.
+    - field_name (str, optional): The schema field being merged (set by the recursion over dicts).
+    Returns:
+    - dict: Lists (e.g. items, draft_items, final_items) concatenated in order, with repeated question_ids made unique (a '_2', '_3', ...
+      suffix); nested objects (e.g. hendrick_context_framework) merged field by field; reflection scores (e.g. ambiguity) averaged;
+      other text fields joined, without repeats.
+    """
+    results = [result for result in results if result is not None]
+    if not results:
+        return None
+    if field_name in REFLECTION_SCORE_FIELDS and not any(isinstance(result, (dict, list)) for result in results):
+        return average_scores(results)
+    if all(isinstance(result, dict) for result in results):
+        keys = list(dict.fromkeys(key for result in results for key in result))
+        return {key: merge_structured_extractions([result.get(key) for result in results], field_name=key) for key in keys}
+    if all(isinstance(result, list) for result in results):
+        merged, seen_question_ids = [], {}
+        for item in (item for result in results for item in result):
+            if isinstance(item, dict) and "question_id" in item:
+                seen_question_ids[item["question_id"]] = seen_question_ids.get(item["question_id"], 0) + 1
+                if seen_question_ids[item["question_id"]] > 1:
+                    item = {**item, "question_id": f"{item['question_id']}_{seen_question_ids[item['question_id']]}"}
+            merged.append(item)
+        return merged
+    if all(isinstance(result, str) for result in results):
+        return "\n\n".join(dict.fromkeys(result for result in results if result.strip()))
+    return results[0]
+
+
+# Extracting questions from a document's pages in budgeted multi-image batches (see batch_pages_by_budget), run concurrently, and merging the results
+def extract_questions_from_image_batches(base64_images, max_workers=8, max_retries=4, max_tokens=MAX_IMAGE_TOKENS_PER_BATCH, max_bytes=MAX_BYTES_PER_BATCH, max_pages=MAX_PAGES_PER_BATCH, extract_function=None, **extract_kwargs):
+    """
+    Parameters:
+    - base64_images (list): The base64 page images, in page order.
+    - max_workers (int): Maximum number of concurrent batch requests.
+    - max_retries (int): Maximum number of retries per batch on transient errors.
+    - max_tokens, max_bytes, max_pages: Per-request budgets (see batch_pages_by_budget).
+    - extract_function (callable): The multi-image extraction function (defaults to extract_questions_from_images).
+    - extract_kwargs: Further keyword arguments passed to extract_function (e.g. model_setting, guiding_principles).
+    Returns:
+    - dict: The merged QuestionExtraction result of all batches (None if every batch failed or came back empty).
+    """
+    base64_images = list(base64_images)
+    page_batches = batch_pages_by_budget(base64_images, max_tokens=max_tokens, max_bytes=max_bytes, max_pages=max_pages)
+    batch_images = [[base64_images[page_num] for page_num in page_batch] for page_batch in page_batches]
+    print(f"Extracting {len(base64_images)} pages in {len(page_batches)} batches")
+    batch_results = extract_pages_concurrently(batch_images, extract_function=extract_function or extract_questions_from_images, max_workers=max_workers, max_retries=max_retries, **extract_kwargs)
+    return merge_structured_extractions([json.loads(batch_json) for batch_json in batch_results if batch_json])
+
+
+def extract_from_multiple_pages_batched(base64_images, original_filename, output_directory, guiding_principles="Clear, simple/intuitive and easy to understand; short/concise; fact-driven and evidence-based, grounded in accurate data and reliable sources.", max_workers=8, max_retries=4, max_tokens=MAX_IMAGE_TOKENS_PER_BATCH, max_bytes=MAX_BYTES_PER_BATCH, max_pages=MAX_PAGES_PER_BATCH):
+    invoice_data = extract_questions_from_image_batches(base64_images, max_workers=max_workers, max_retries=max_retries, max_tokens=max_tokens, max_bytes=max_bytes, max_pages=max_pages, model_setting="gpt-4o-2024-08-06", guiding_principles=guiding_principles, temperature_setting=0.2)
+    # Check if the result is None/empty (i.e. every batch failed or came back empty)
+    if not invoice_data:
+        return None # If yes, there is nothing to save
     # Ensure the output directory exists
     os.makedirs(output_directory, exist_ok=True)
     # Construct the output file path
@@ -558,13 +711,16 @@ def extract_from_multiple_pages(base64_images, original_filename, output_directo
     return output_filename
 
 
-def main_extract(read_path, write_path):
+def main_extract(read_path, write_path, max_workers=None, batched=True):
     for filename in os.listdir(read_path):
         if filename[-4:] == '.pdf':
             file_path = os.path.join(read_path, filename)
             if os.path.isfile(file_path):
-                base64_images = pdf_to_base64_images(file_path)
-                extract_from_multiple_pages(base64_images, filename, write_path)
+                base64_images = pdf_to_base64_images_parallel(file_path, max_workers=max_workers) # Pages rendered across all cores
+                if batched: # Several pages per request (under the token/byte budgets), one merged result per document
+                    extract_from_multiple_pages_batched(base64_images, filename, write_path)
+                else: # One request per page, one result per page
+                    extract_from_multiple_pages(base64_images, filename, write_path)
 
 
 
@@ -701,7 +857,7 @@ def transform_data_into_schema(json_raw, json_schema, temperature_setting=0.7, m
         middle_content = middle_content_start + middle_content_middle + middle_content_end
     # The final user message prompt
     user_message = f"Transform the following raw JSON data according to the provided 'AgentReasoning' schema. Ensure all data is in English and formatted as required. Here is the raw JSON: {json_raw}.{middle_content}{end_content}"
-    response = client.beta.chat.completions.parse(
+    response_content = cached_completion_content(client.beta.chat.completions.parse,
         model=model_setting,
         messages=[
             {
@@ -729,7 +885,7 @@ def transform_data_into_schema(json_raw, json_schema, temperature_setting=0.7, m
         #logit_bias=logit_bias_setting,
         logprobs=logprobs_setting,
     )
-    return json.loads(response.choices[0].message.content)
+    return json.loads(response_content)
 
 
 def main_transform(extracted_invoice_json_path, json_schema, save_path, guiding_principles="Clear, simple/intuitive and easy to understand; short/concise; fact-driven and evidence-based, grounded in accurate data and reliable sources."):
@@ -842,66 +998,68 @@ def ingest_transformed_jsons_postgres(json_folder_path, db_config):
 
 ##### ------ MAIN CODE - START ------- ####
 
-# -- Step 1)
-read_path = "./data/inputs/pdfs/"
-write_path = "./data/outputs/intermediate/"
+# Guarded, so that this script can be imported (by the rasteriser's worker processes, or surveylm_question_table_generator_check_v1.py) without running the pipeline
+if __name__ == "__main__":
+    # -- Step 1)
+    read_path = "./data/inputs/pdfs/"
+    write_path = "./data/outputs/intermediate/"
 
-main_extract(read_path, write_path)
+    main_extract(read_path, write_path)
 
-# -- Step 2)
+    # -- Step 2)
 
-# Define the json_schema
-json_schema = {
-            "type": "object",
-            "properties": {
-                "items": {
-                    "type": "array",
+    # Define the json_schema
+    json_schema = {
+                "type": "object",
+                "properties": {
                     "items": {
-                        "type": "object",
-                        "properties": {
-                            "question": {
-                                "type": "string"
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "question": {
+                                    "type": "string"
+                                },
+                                "question_id": {
+                                    "type": "string"
+                                },
+                                "answer_instruction": {
+                                    "type": "string"
+                                }
                             },
-                            "question_id": {
-                                "type": "string"
-                            },
-                            "answer_instruction": {
-                                "type": "string"
-                            }
-                        },
-                        "required": ["question", "question_id", "answer_instruction"]
+                            "required": ["question", "question_id", "answer_instruction"]
+                        }
+                    },
+                    "epistemology_ontology_methodology": {
+                        "type": "string"
+                    },
+                    "questions_hypotheses": {
+                        "type": "string"
+                    },
+                    "methods": {
+                        "type": "string"
                     }
                 },
-                "epistemology_ontology_methodology": {
-                    "type": "string"
-                },
-                "questions_hypotheses": {
-                    "type": "string"
-                },
-                "methods": {
-                    "type": "string"
-                }
-            },
-            "required": ["items", "epistemology_ontology_methodology", "questions_hypotheses", "methods"]
-        }
+                "required": ["items", "epistemology_ontology_methodology", "questions_hypotheses", "methods"]
+            }
 
-extracted_json_path = "./data/outputs/intermediate/"
-save_path = "./data/outputs/intermediate/transformed/"
-main_transform(extracted_json_path, json_schema, save_path)
+    extracted_json_path = "./data/outputs/intermediate/"
+    save_path = "./data/outputs/intermediate/transformed/"
+    main_transform(extracted_json_path, json_schema, save_path)
 
-# -- Step 3)
+    # -- Step 3)
 
-# - Option A) Example usage with save to csv files
-json_folder_path = "./data/outputs/intermediate/transformed/"
-save_folder_path = "./data/outputs/"
-ingest_transformed_jsons_to_csv_files(json_folder_path, save_folder_path)
+    # - Option A) Example usage with save to csv files
+    json_folder_path = "./data/outputs/intermediate/transformed/"
+    save_folder_path = "./data/outputs/"
+    ingest_transformed_jsons_to_csv_files(json_folder_path, save_folder_path)
 
-# - Option B) Example usage with save to postgresql (Optional)
-# Get database connection details from environment variables
-#db_config = {"dbname": "XXXX", "user": "XXXX", "password": "XXXX", "host": "XXXX", "port": "1234"}
+    # - Option B) Example usage with save to postgresql (Optional)
+    # Get database connection details from environment variables
+    #db_config = {"dbname": "XXXX", "user": "XXXX", "password": "XXXX", "host": "XXXX", "port": "1234"}
 
-# Read in the jsons and ingest/push to postgres
-#json_folder_path = "./data/outputs/intermediate/transformed/"
-#ingest_transformed_jsons_postgres(json_folder_path, db_config)
+    # Read in the jsons and ingest/push to postgres
+    #json_folder_path = "./data/outputs/intermediate/transformed/"
+    #ingest_transformed_jsons_postgres(json_folder_path, db_config)
 
 ##### ------ MAIN CODE - END ------- ####
\ No newline at end of file
@@ -2,14 +2,17 @@
 
 from pydantic import BaseModel
 from openai import OpenAI
-import fitz  # PyMuPDF
-import io
 import os
-from PIL import Image
 import base64
 import json
 import psycopg2
 import pandas as pd
+import sys
+
+# Shared on-disk cache of OpenAI responses and PDF rasteriser, imported from the same folder (whatever the working directory)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from surveylm_openai_cache_v1 import cached_completion_content
+from surveylm_pdf_rasteriser_v1 import pdf_to_base64_images_parallel, base64_image_data_url
 
 
 ##### ------ DEFINE FUNCTIONS - START ------- ####
@@ -18,32 +21,6 @@ import pandas as pd
 client = OpenAI()
 
 
-@staticmethod
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
-
-
-def pdf_to_base64_images(pdf_path):
-    #Handles PDFs with multiple pages
-    pdf_document = fitz.open(pdf_path)
-    base64_images = []
-    temp_image_paths = []
-    total_pages = len(pdf_document)
-    for page_num in range(total_pages):
-        page = pdf_document.load_page(page_num)
-        pix = page.get_pixmap()
-        img = Image.open(io.BytesIO(pix.tobytes()))
-        temp_image_path = f"temp_page_{page_num}.png"
-        img.save(temp_image_path, format="PNG")
-        temp_image_paths.append(temp_image_path)
-        base64_image = encode_image(temp_image_path)
-        base64_images.append(base64_image)
-    for temp_image_path in temp_image_paths:
-        os.remove(temp_image_path)
-    return base64_images
-
-
 # In the extract_invoice_data function, modify the system prompt to extract relevant CV data such as name, contact information, work experience, education, skills, etc.
 def extract_cv_data(base64_image, temperature_setting=0.0):
     system_prompt = f"""
@@ -53,7 +30,7 @@ def extract_cv_data(base64_image, temperature_setting=0.0):
     3. If some sections (e.g., skills or certifications) are missing, include them as "null" values.
     4. Maintain the structure of the resume while grouping similar information together.
     """
-    response = client.chat.completions.create(
+    response_content = cached_completion_content(client.chat.completions.create,
         model="gpt-4o",
         response_format={"type": "json_object"},
         messages=[
@@ -66,13 +43,13 @@ def extract_cv_data(base64_image, temperature_setting=0.0):
                 "content": [
                     {"type": "text", "text": "extract the data from this resume and output it into JSON"},
                     {"type": "image_url",
-                     "image_url": {"url": f"data:image/png;base64,{base64_image}", "detail": "high"}}
+                     "image_url": {"url": base64_image_data_url(base64_image), "detail": "high"}}
                 ]
             }
         ],
         temperature=temperature_setting,
     )
-    return response.choices[0].message.content
+    return response_content
 
 
 def extract_from_multiple_pages(base64_images, original_filename, output_directory):
@@ -91,12 +68,12 @@ def extract_from_multiple_pages(base64_images, original_filename, output_directo
     return output_filename
 
 
-def main_extract(read_path, write_path):
+def main_extract(read_path, write_path, max_workers=None):
     for filename in os.listdir(read_path):
         if filename[-4:] == '.pdf':
             file_path = os.path.join(read_path, filename)
             if os.path.isfile(file_path):
-                base64_images = pdf_to_base64_images(file_path)
+                base64_images = pdf_to_base64_images_parallel(file_path, max_workers=max_workers) # Pages rendered across all cores
                 extract_from_multiple_pages(base64_images, filename, write_path)
 
 
@@ -140,7 +117,7 @@ def transform_data_into_schema(json_raw, json_schema, temperature_setting=0.2, m
     Here is the schema:
     {json_schema}
     """
-    response = client.beta.chat.completions.parse(
+    response_content = cached_completion_content(client.beta.chat.completions.parse,
         model=model,
         messages=[
             {
@@ -158,7 +135,7 @@ def transform_data_into_schema(json_raw, json_schema, temperature_setting=0.2, m
         response_format = ResumeInformationExtraction,
         temperature=temperature_setting,
     )
-    return json.loads(response.choices[0].message.content)
+    return json.loads(response_content)
 
 
 def main_transform(extracted_invoice_json_path, json_schema, save_path):
@@ -417,74 +394,75 @@ def ingest_transformed_jsons_postgres(json_folder_path, db_config):
 
 ##### ------ MAIN CODE - START ------- ####
 
-# -- Step 1)
-read_path = "./data/inputs/pdfs/"
-write_path = "./data/outputs/intermediate/"
-
-main_extract(read_path, write_path)
-
-# -- Step 2)
-
-# Define the schema to capture standard resume fields such as personal details, education, work experience, skills, etc.
-cv_schema = {
-    "personal_details": {
-        "name": "string",
-        "email": "string",
-        "phone": "string",
-        "address": "string"
-    },
-    "work_experience": [
-        {
-            "company_name": "string",
-            "position": "string",
-            "start_date": "YYYY-MM-DD",
-            "end_date": "YYYY-MM-DD",
-            "description": "string"
-        }
-    ],
-    "education": [
-        {
-            "institution_name": "string",
-            "degree": "string",
-            "start_date": "YYYY-MM-DD",
-            "end_date": "YYYY-MM-DD",
-            "description": "string"
-        }
-    ],
-    "technical_skills": ["string"],
-    "soft_skills": ["string"],
-    "certifications": ["string"],
-    "languages": ["string"],
-    "hobbies": ["string"]
-}
-
-extracted_invoice_json_path = "./data/outputs/intermediate/"
-save_path = "./data/outputs/intermediate/transformed/"
-main_transform(extracted_invoice_json_path, cv_schema, save_path)
-
-# -- Step 3)
-
-# Get database connection details from environment variables
-db_config = {
-    "dbname": os.getenv("DB_NAME"),
-    "user": os.getenv("DB_USER"),
-    "password": os.getenv("DB_PASSWORD"),
-    "host": os.getenv("DB_HOST"),
-    "port": os.getenv("DB_PORT")
-}
-
-# Read in the jsons and ingest/push to postgres
-json_folder_path = "./data/outputs/intermediate/transformed/"
-ingest_transformed_jsons_postgres(json_folder_path, db_config)
-
-# Example usage with save to csv files instead
-#save_folder_path = "./data/outputs/"
-#ingest_transformed_jsons_to_csv_files(json_folder_path, save_folder_path)
-
-# Example usage
-save_file_path = "./data/outputs/wide_resumes_output.csv"
-ingest_transformed_jsons_to_wide_csv(json_folder_path, save_file_path)
-
+# Guarded, so that the rasteriser's worker processes can import this script without re-running it
+if __name__ == "__main__":
+    # -- Step 1)
+    read_path = "./data/inputs/pdfs/"
+    write_path = "./data/outputs/intermediate/"
+
+    main_extract(read_path, write_path)
+
+    # -- Step 2)
+
+    # Define the schema to capture standard resume fields such as personal details, education, work experience, skills, etc.
+    cv_schema = {
+        "personal_details": {
+            "name": "string",
+            "email": "string",
+            "phone": "string",
+            "address": "string"
+        },
+        "work_experience": [
+            {
+                "company_name": "string",
+                "position": "string",
+                "start_date": "YYYY-MM-DD",
+                "end_date": "YYYY-MM-DD",
+                "description": "string"
+            }
+        ],
+        "education": [
+            {
+                "institution_name": "string",
+                "degree": "string",
+                "start_date": "YYYY-MM-DD",
+                "end_date": "YYYY-MM-DD",
+                "description": "string"
+            }
+        ],
+        "technical_skills": ["string"],
+        "soft_skills": ["string"],
+        "certifications": ["string"],
+        "languages": ["string"],
+        "hobbies": ["string"]
+    }
+
+    extracted_invoice_json_path = "./data/outputs/intermediate/"
+    save_path = "./data/outputs/intermediate/transformed/"
+    main_transform(extracted_invoice_json_path, cv_schema, save_path)
+
+    # -- Step 3)
+
+    # Get database connection details from environment variables
+    db_config = {
+        "dbname": os.getenv("DB_NAME"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+        "host": os.getenv("DB_HOST"),
+        "port": os.getenv("DB_PORT")
+    }
+
+    # Read in the jsons and ingest/push to postgres
+    json_folder_path = "./data/outputs/intermediate/transformed/"
+    ingest_transformed_jsons_postgres(json_folder_path, db_config)
+
+    # Example usage with save to csv files instead
+    #save_folder_path = "./data/outputs/"
+    #ingest_transformed_jsons_to_csv_files(json_folder_path, save_folder_path)
+
+    # Example usage
+    save_file_path = "./data/outputs/wide_resumes_output.csv"
+    ingest_transformed_jsons_to_wide_csv(json_folder_path, save_file_path)
 
 ##### ------ MAIN CODE - END ------- ####
 